@@ -0,0 +1,129 @@
+"""Fetch and archive the datasets of the registry (`utils/dataset_registry.py`)
+that have new data, several at a time. See `utils/soda_archiver.py`.
+
+Example:
+```bash
+python archive_datasets.py nhsn_consol nhsn_prelim --dry-run
+```
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+from utils.dataset_registry import load_registry
+from utils.soda_archiver import archive_datasets
+
+
+def main():
+    args = parse_args()
+    registry = load_registry(args.registry_file)
+
+    if args.list:
+        for name, spec in registry.items():
+            print(f"{name:<24}{spec['uuid']:<12}{spec['output_dir']}")
+        return
+
+    names = args.datasets or list(registry)
+    unknown = [name for name in names if name not in registry]
+    if unknown:
+        raise ValueError(f"Datasets not registered: {unknown}. Options are: {list(registry)}")
+
+    # Command line overrides of the per-dataset limits
+    for name in names:
+        if args.page_size is not None:
+            registry[name]["page_size"] = args.page_size
+        if args.max_concurrency is not None:
+            registry[name]["max_concurrency"] = args.max_concurrency
+
+    results = archive_datasets(
+        registry, names, max_datasets=args.max_datasets,
+        fetch_trigger=args.fetch_trigger, force=args.force, dry_run=args.dry_run,
+        hooks=None if args.hooks else list(),
+    )
+
+    for result in results:
+        failed_hooks = f"(failed hooks: {result['failed_hooks']})" if result["failed_hooks"] else ""
+        print(f"{result['dataset']:<24}{result['status']:<16}{failed_hooks}")
+    sys.exit(1 if any(result["status"] == "failed" for result in results) else 0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "datasets",
+        nargs="*",
+        help="Names of the datasets to archive. Defaults to all registered "
+             "datasets.",
+    )
+
+    parser.add_argument(
+        "--registry-file",
+        type=Path,
+        help="YAML file with more datasets (see `utils/dataset_registry.py`).",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-datasets",
+        type=int,
+        help="Number of datasets processed at the same time.",
+        default=4,
+    )
+
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        help="Rows per request, for all datasets. Defaults to the value "
+             "of each dataset in the registry.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="Concurrent requests per dataset, for all datasets. Defaults "
+             "to the value of each dataset in the registry.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--fetch-trigger",
+        type=str,
+        help="Specifies the event that triggered the data fetch request, "
+             "to include in the file metadata.",
+        default="manual",
+    )
+
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Fetch the datasets even if the archive is up to date.",
+    )
+
+    parser.add_argument(
+        "--hooks",
+        action=argparse.BooleanOptionalAction,
+        help="Whether to run the post-archive hooks of each dataset "
+             "(`post_archive_hooks` in the registry) on its new file.",
+        default=True,
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only check which datasets have new data.",
+    )
+
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="List the registered datasets and exit.",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Measure the startup (import) time of the entry points, using
+`python -X importtime`.
+
+For each command, reports the wall time of the whole run, the total
+import time and the slowest top-level imports. Run from the repository
+root:
+```bash
+python benchmarks/startup_importtime.py
+python benchmarks/startup_importtime.py --repeat 5 --top 8
+```
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Metadata-only operations, which should not import pandas or plotly
+_DEFAULT_COMMANDS = [
+    ["get_nhsn_snapshot.py", "--list-catalog"],
+    ["get_nhsn_snapshot.py", "--help"],
+    ["watch_nhsn_releases.py", "--help"],
+    ["generate_simple_report.py", "--list-vintages"],
+]
+
+_HEAVY_MODULES = ["pandas", "numpy", "plotly", "jinja2"]
+
+
+def main():
+    args = parse_args()
+
+    for command in _DEFAULT_COMMANDS:
+        wall_times = list()
+        import_times = list()
+        for _ in range(args.repeat):
+            wall_time, imports = run_importtime(command)
+            wall_times.append(wall_time)
+            import_times.append(sum(self_us for self_us, _, _ in imports) / 1E6)
+
+        print(f"\n$ python {' '.join(command)}")
+        print(f"  Wall time (median of {args.repeat}): {statistics.median(wall_times):.3f} s")
+        print(f"  Import time (median of {args.repeat}): {statistics.median(import_times):.3f} s")
+
+        # Heavy modules that were imported
+        imported_names = {name.strip() for _, _, name in imports}
+        heavy = [name for name in _HEAVY_MODULES if name in imported_names]
+        print(f"  Heavy modules imported: {heavy if heavy else 'none'}")
+
+        # Slowest top-level imports (of the last run)
+        top_level = [item for item in imports if not item[2].startswith(" ")]
+        top_level.sort(key=lambda item: item[1], reverse=True)
+        print(f"  Slowest top-level imports (cumulative):")
+        for _, cumulative_us, name in top_level[:args.top]:
+            print(f"    {cumulative_us / 1E3:9.1f} ms  {name}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--repeat", "-n",
+        type=int,
+        help="Number of runs of each command.",
+        default=3,
+    )
+
+    parser.add_argument(
+        "--top",
+        type=int,
+        help="Number of top-level imports to show for each command.",
+        default=5,
+    )
+
+    return parser.parse_args()
+
+
+def run_importtime(command) -> tuple:
+    """Run a command with `python -X importtime`. Returns the wall time
+    and a list of (self [us], cumulative [us], module name) entries. The
+    module name keeps the indentation given by `importtime`: nested
+    imports start with spaces.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + command,
+        capture_output=True, text=True,
+    )
+    wall_time = time.perf_counter() - start
+
+    imports = list()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((int(self_us), int(cumulative_us), name[1:]))
+
+    return wall_time, imports
+
+
+if __name__ == "__main__":
+    main()
@@ -5,25 +5,31 @@ jurisdictions. Shows the time series as of each report date.
 Concepts:
 - as_of_date: Date and time in which the dataset was updated. "As of" date.
 - date: Date of the report, attributed to the hospitalization event.
+
+Pandas, plotly and jinja2 are only imported by the steps that use them,
+so that `--list-vintages` (which only reads the catalog) starts fast.
 """
+from __future__ import annotations
+
+import argparse
 import json
 import logging
 import os
-import shutil
 import sys
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo
 
-import jinja2
-import numpy as np
-import pandas as pd
-import plotly
-import plotly.graph_objects as go
-import plotly.express as px
-
-from utils.nhsn_data import DISEASE_CODE3_TO_NAME
+from utils.nhsn_metadata import get_entry_data_updated_at
+from utils.site_publish import hashed_path, publish_site
 from utils.yaml_tools import load_yaml
 
+if TYPE_CHECKING:
+    import pandas as pd
+
 
 _LOGGER = logging.getLogger(__name__)
 _LOGGER.setLevel(logging.DEBUG)
@@ -31,9 +37,23 @@ _LOGGER.addHandler(logging.StreamHandler(sys.stdout))
 
 
 def main():
+    args = parse_args()
     params = Params()
     data = Data()
 
+    # Command line overrides of the vintage thinning
+    if args.vintage_thinning is not None:
+        params.vintage_thinning = args.vintage_thinning
+    if args.vintage_keep_last is not None:
+        params.vintage_keep_last = args.vintage_keep_last
+    if args.max_vintages is not None:
+        params.max_vintages = args.max_vintages
+
+    if args.list_vintages:
+        for date, file_entry in select_files(params, data).items():
+            print(f"{date.date().isoformat()}  {file_entry['filename']}")
+        return
+
     load_data(params, data)
     prepare_plots(params, data)
     fill_templates(params, data)
@@ -48,7 +68,7 @@ class Params:
         # Respiratory dataset
         self.dataset_dir = Path("./datasets/nhsn_weekly_jurisdiction")
         self.dataset_metadata_fname: str = "metadata.yaml"
-        self.minimum_as_of_date: pd.Timestamp = pd.Timestamp("2024-12-04")
+        self.minimum_as_of_date: datetime = datetime(2024, 12, 4)
         self.date_colname: str = "weekendingdate"
         self.jurisdiction_colname: str = "jurisdiction"
         self.hosp_colname_fmt: str = "totalconf{}newadm"
@@ -56,13 +76,37 @@ class Params:
 
         # Plot options – Hospitalizations time series
         self.show_default_jurisd: str = "USA"  # Jurisdiction to show when plots are created
-        self.plot_date_lim_left: pd.Timestamp = pd.Timestamp.now() - pd.Timedelta("15w")# Timestamp("2024-01-01")  # Earliest date to show on plots' default view
-        # self.plot_date_lim_left: pd.Timestamp = pd.Timestamp("2024-01-01")  # Earliest date to show on plots' default view
+        self.plot_date_lim_left: datetime = datetime.now() - timedelta(weeks=15)# datetime(2024, 1, 1)  # Earliest date to show on plots' default view
+        # self.plot_date_lim_left: datetime = datetime(2024, 1, 1)  # Earliest date to show on plots' default view
+
+        # Plot options – History embedded in the page for each as-of trace
+        self.trace_history_mode: str = "window"
+        #   ^ ^  "full": embed the whole history of each trace.
+        #        "window": embed only the weeks after `trace_window_left`.
+        #        "decimate": embed the window plus every n-th older week.
+        #   In "window" and "decimate" modes, the full history is exported to
+        #   separate data files, loaded by the page when the user zooms out.
+        self.trace_window_left: datetime = self.plot_date_lim_left - timedelta(weeks=8)
+        self.trace_decimate_step: int = 4  # Keep one every n weeks before the window
+        self.full_series_dir: str = "data"  # Subdirectory of the full history files
+
+        # Plot options – Thinning of the plotted as-of dates (vintages). See `select_vintages`.
+        self.vintage_thinning: str = "all"  # "all", "last_n", "weekly" or "exponential"
+        self.vintage_keep_last: int = 12  # Recent vintages always kept ("last_n" and "exponential")
+        self.max_vintages: int = None  # Ceiling to the number of plotted vintages (None for no limit)
+
+        # Plot options – Nowcast of the recent weeks of the latest snapshot. See `utils/nhsn_nowcast.py`.
+        self.show_nowcast: bool = True
+        self.nowcast_max_lag: int = 8  # Number of recent weeks corrected
+        self.nowcast_interval: float = 0.9  # Probability mass of the uncertainty band
 
         # HTML page and templates
         self.templates_dir = Path("./html_templates")
         self.pages_build_dir = Path("./pages")
 
+        # Parallelism: figures of each disease are built in separate processes
+        self.num_workers: int = os.cpu_count() or 1
+
         # Misc
         self.locations_path = Path("./aux_data/us_locations.csv")
 
@@ -77,51 +121,69 @@ class Data:
     index_page_content: str   # HTML content for the index page
 
     jur_trace_indices: dict  # Indexes of the traces belonging to each location
+    nowcast_trace_indices: dict  # Indexes of the nowcast traces (band and median) of each location
+    nowcast_df: pd.DataFrame  # Nowcast of the latest snapshot, for all locations and diseases
     disease_codes: list      # 3-letter disease codes: "flu", "c19", "rsv"
+    full_series_dict: dict   # Full history of the traces, keyed by (disease code, jurisdiction)
 
     def __init__(self):
         self.template_fill_dict = dict()
+        self.full_series_dict = dict()
+        self.nowcast_trace_indices = dict()
+        self.nowcast_df = None
 
 
 def parse_args():
-    pass
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--list-vintages",
+        action="store_true",
+        help="List the as-of dates (and files) selected for the report, "
+             "after thinning, and exit without building it.",
+    )
+
+    parser.add_argument(
+        "--vintage-thinning",
+        type=str,
+        choices=["all", "last_n", "weekly", "exponential"],
+        help="Policy to thin out the plotted as-of dates (see "
+             "`select_vintages`). Defaults to all as-of dates.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--vintage-keep-last",
+        type=int,
+        help="Number of recent as-of dates always kept by the `last_n` "
+             "and `exponential` policies.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-vintages",
+        type=int,
+        help="Ceiling to the number of plotted as-of dates.",
+        default=None,
+    )
+
+    return parser.parse_args()
 
 
 def load_data(params: Params, data: Data):
+    import pandas as pd
 
     # Load locations data
     # ============
     data.locations_df = pd.read_csv(params.locations_path)
 
-    # Load dataset metadata
-    # ============
-    dataset_metadata_path = params.dataset_dir / params.dataset_metadata_fname
-    data.dataset_metadata_dict = load_yaml(dataset_metadata_path)
-
-    # Load each file in the dataset
+    # Load each selected file in the dataset
     # ============
     df_list = list()
     key_list = list()
-    for file_entry in data.dataset_metadata_dict["files"]:
-
-        # Preprocess (CHANGES INPLACE) the file metadata
+    for date, file_entry in select_files(params, data).items():
         file_path = params.dataset_dir / file_entry["filename"]
 
-        # --- Convert to pandas datetime and EST timezone
-        file_entry["data_updated_at"] = pd.Timestamp(file_entry["data_updated_at"])
-        if file_entry["data_updated_at"].tzinfo is not None:
-            file_entry["data_updated_at"] = file_entry["data_updated_at"].astimezone("US/Eastern").replace(tzinfo=None)
-
-        # Filters
-        # =======
-        if not file_path.exists():
-            _LOGGER.warning(f"File {file_path} does not exist. Skipping.")
-            continue
-
-        if file_entry["data_updated_at"] < params.minimum_as_of_date:
-            _LOGGER.info(f"Dataset on {file_path} is before minimmum date. Skipping.")
-            continue
-
         # Loading
         # ======
         _LOGGER.debug(f"Loading {file_entry['filename']}")
@@ -135,14 +197,9 @@ def load_data(params: Params, data: Data):
             _LOGGER.error(f"File {file_path} could not be parsed. Skipping.")
             continue
 
-        date = pd.Timestamp(file_entry["data_updated_at"].date())  # Retain the date only, reset hour
-        if date in key_list:
-            _LOGGER.warning(f"Duplicate date {date} in file {file_path}. Skipping.")
-            continue
-
         _LOGGER.info(f"Loaded {file_entry['filename']}")
         df_list.append(df)
-        key_list.append(date)
+        key_list.append(pd.Timestamp(date))
 
     if len(df_list) == 0:
         _LOGGER.error("No files loaded. Exiting.")
@@ -156,127 +213,351 @@ def load_data(params: Params, data: Data):
     )
 
 
+def select_files(params: Params, data: Data) -> dict:
+    """Read the dataset metadata and select the files (one per as-of
+    date) to load, after the filters and the vintage thinning.
+
+    Returns a dictionary from the as-of date to the file metadata entry,
+    sorted by date.
+    """
+    # Load dataset metadata
+    # ============
+    dataset_metadata_path = params.dataset_dir / params.dataset_metadata_fname
+    data.dataset_metadata_dict = load_yaml(dataset_metadata_path)
+
+    # Select the files to load
+    # ============
+    candidate_entries = dict()  # Keyed by as-of date
+    for file_entry in data.dataset_metadata_dict["files"]:
+
+        # Preprocess (CHANGES INPLACE) the file metadata
+        file_path = params.dataset_dir / file_entry["filename"]
+
+        # --- Convert to datetime and EST timezone
+        file_entry["data_updated_at"] = _parse_entry_datetime(get_entry_data_updated_at(file_entry))
+
+        # Filters
+        # =======
+        if not file_path.exists():
+            _LOGGER.warning(f"File {file_path} does not exist. Skipping.")
+            continue
+
+        if file_entry["data_updated_at"] < params.minimum_as_of_date:
+            _LOGGER.info(f"Dataset on {file_path} is before minimmum date. Skipping.")
+            continue
+
+        date = datetime.combine(file_entry["data_updated_at"].date(), datetime.min.time())  # Retain the date only, reset hour
+        if date in candidate_entries:
+            _LOGGER.warning(f"Duplicate date {date} in file {file_path}. Skipping.")
+            continue
+
+        candidate_entries[date] = file_entry
+
+    # --- Thin out the as-of dates (vintages) to plot
+    selected_dates = select_vintages(
+        list(candidate_entries.keys()), params.vintage_thinning,
+        keep_last=params.vintage_keep_last, max_vintages=params.max_vintages,
+    )
+    _LOGGER.info(
+        f"Vintage thinning ({params.vintage_thinning}): "
+        f"{len(selected_dates)} of {len(candidate_entries)} as-of dates selected")
+
+    return {date: candidate_entries[date] for date in selected_dates}
+
+
+def _parse_entry_datetime(value) -> datetime:
+    """Convert a `data_updated_at` catalog field into a naive datetime in
+    US/Eastern time. Values without time zone are kept as they are.
+    """
+    if isinstance(value, datetime):
+        result = value
+    elif isinstance(value, date):
+        result = datetime(value.year, value.month, value.day)
+    else:
+        result = datetime.fromisoformat(str(value))
+    if result.tzinfo is not None:
+        result = result.astimezone(ZoneInfo("US/Eastern")).replace(tzinfo=None)
+    return result
+
+
+def select_vintages(as_of_dates, policy="all", keep_last=12, max_vintages=None) -> list:
+    """Select which as-of dates (vintages) are plotted in the report.
+
+    Parameters
+    ----------
+    as_of_dates : list
+        As-of dates (datetime-like) of the available snapshots.
+    policy : str
+        Thinning policy:
+        - "all": keep all vintages.
+        - "last_n": keep the `keep_last` most recent vintages.
+        - "weekly": keep the most recent vintage of each week.
+        - "exponential": keep the `keep_last` most recent vintages, then
+          older ones with spacing that doubles at each selected vintage
+          (1 week, 2 weeks, 4 weeks...).
+    keep_last : int
+        Number of recent vintages kept by the "last_n" and "exponential"
+        policies.
+    max_vintages : int, optional
+        Ceiling to the number of vintages, applied after the policy.
+        The most recent ones are kept.
+
+    Returns
+    -------
+    list
+        The selected as-of dates, sorted from oldest to newest.
+    """
+    dates = sorted(as_of_dates, reverse=True)  # Newest first
+
+    if policy == "all":
+        selected = dates
+    elif policy == "last_n":
+        selected = dates[:keep_last]
+    elif policy == "weekly":
+        selected = list()
+        seen_weeks = set()
+        for date in dates:
+            week = tuple(date.isocalendar())[:2]  # (Year, week)
+            if week not in seen_weeks:
+                seen_weeks.add(week)
+                selected.append(date)
+    elif policy == "exponential":
+        selected = dates[:keep_last]
+        gap = timedelta(weeks=1)
+        for date in dates[keep_last:]:
+            if len(selected) == 0 or selected[-1] - date >= gap:
+                selected.append(date)
+                gap *= 2
+    else:
+        raise ValueError(f"Unrecognized vintage thinning policy: {policy}")
+
+    if max_vintages is not None:
+        selected = selected[:max_vintages]
+
+    return sorted(selected)
+
+
 def prepare_plots(params: Params, data: Data):
 
     # --- Initialize plots and surrounding data
     data.disease_codes = ["c19", "flu", "rsv"]
-    fig_dict = {code: go.Figure() for code in data.disease_codes}
+    max_date = data.main_archive_df.index.get_level_values("weekendingdate").max()
+
+    # --- Track the traces belonging to each jurisdiction
+    # One trace per (jurisdiction, as-of date), in the same order in all figures
+    i_trace = 0
+    data.jur_trace_indices = defaultdict(list)
+    for jur_abbrev, jur_df in data.main_archive_df.groupby(by="jurisdiction", group_keys=False):
+        num_as_of = len(jur_df.index.get_level_values("as_of_date").unique())
+        data.jur_trace_indices[jur_abbrev] = list(range(i_trace, i_trace + num_as_of))
+        i_trace += num_as_of
+
+    # The nowcast traces come after all the others, three per jurisdiction
+    if params.show_nowcast:
+        from utils.nhsn_nowcast import nowcast_latest
+
+        _LOGGER.info("Computing the nowcast of the latest snapshot")
+        data.nowcast_df = nowcast_latest(
+            params.dataset_dir, max_lag=params.nowcast_max_lag,
+            interval=params.nowcast_interval,
+        )
+        for jur_abbrev in data.jur_trace_indices:
+            data.nowcast_trace_indices[jur_abbrev] = list(range(i_trace, i_trace + 3))
+            i_trace += 3
 
-    num_jurisdictions = len(data.main_archive_df.index.get_level_values("jurisdiction").unique())
+    # Build and export the figures, one disease per worker
+    # ==============
+    # Each worker only receives the column of its own disease
+    jobs = list()
+    for code in data.disease_codes:
+        colname = params.hosp_colname_fmt.format(code)
+        nowcast_df = None
+        if data.nowcast_df is not None:
+            nowcast_df = data.nowcast_df.loc[data.nowcast_df["field"] == colname]
+        jobs.append((params, code, data.main_archive_df[colname], max_date, nowcast_df))
+
+    num_workers = min(params.num_workers, len(jobs))
+    if num_workers > 1:
+        _LOGGER.info(f"Building plots in {num_workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(_build_disease_figure_html, *zip(*jobs)))
+    else:
+        results = [_build_disease_figure_html(*job) for job in jobs]
+
+    # Export figure HTML into the template filling contents
+    for code, (fig_html, full_series) in zip(data.disease_codes, results):
+        data.template_fill_dict[f"{code}_fig"] = fig_html
+
+        # Full history files, one per disease and jurisdiction
+        for jur_abbrev, jur_series in full_series.items():
+            data.full_series_dict[(code, jur_abbrev)] = json.dumps(jur_series)
+
+
+def _build_disease_figure_html(
+        params: Params, disease_code: str, hosp_sr: pd.Series, max_date: pd.Timestamp,
+        nowcast_df: pd.DataFrame = None,
+) -> tuple:
+    """Build the figure of one disease and export it to HTML. Runs on a
+    worker process when `params.num_workers` > 1.
+
+    Returns the figure HTML and a dictionary with the full history of the
+    traces of each jurisdiction (empty if `params.trace_history_mode` is
+    "full"). Each value is a list of {"x": [...], "y": [...]}, in the
+    same order as the traces of the jurisdiction.
+
+    Parameters
+    ----------
+    params : Params
+    disease_code : str
+        3-letter disease code: "c19", "flu" or "rsv".
+    hosp_sr : pd.Series
+        Hospitalizations of the disease, indexed by
+        (as_of_date, weekendingdate, jurisdiction).
+    max_date : pd.Timestamp
+        Last week ending date in the archive (right limit of the plots).
+    nowcast_df : pd.DataFrame, optional
+        Nowcast of the disease (see `utils.nhsn_nowcast.apply_completeness`).
+        If given, three traces (band bounds and median) are added per
+        jurisdiction, after all the as-of traces.
+    """
+    import plotly.graph_objects as go
+
+    fig = go.Figure()
+    full_series = defaultdict(list)
+
+    num_jurisdictions = len(hosp_sr.index.get_level_values("jurisdiction").unique())
 
     # Plot data
     # ===================
 
     # --- Loop over jurisdictions
-    i_trace = 0
-    data.jur_trace_indices = defaultdict(list)  # Keeps track of the trace indices belonging to each jurisdiction
-    for i_jur, (jur_abbrev, jur_df) in (
-            enumerate(data.main_archive_df.groupby(by="jurisdiction", group_keys=False))):
-        jur_df = jur_df.droplevel("jurisdiction")
+    for i_jur, (jur_abbrev, jur_sr) in (
+            enumerate(hosp_sr.groupby(by="jurisdiction", group_keys=False))):
+        jur_sr = jur_sr.droplevel("jurisdiction")
         # Jurisdiction visible by default
         start_visible = (jur_abbrev == params.show_default_jurisd)
 
         # Report progress
         if i_jur % 10 == 0:
-            _LOGGER.info(f"Processing jurisdiction {jur_abbrev} ({i_jur} / {num_jurisdictions})")
+            _LOGGER.info(f"[{disease_code}] Processing jurisdiction {jur_abbrev} ({i_jur} / {num_jurisdictions})")
 
         # --- Loop over as-of dates
-        for i_as_of, (as_of_date, as_of_df) in (
-                enumerate(jur_df.groupby(
+        for i_as_of, (as_of_date, as_of_sr) in (
+                enumerate(jur_sr.groupby(
                     by="as_of_date", group_keys=False, sort=True,
                 ))):
-            as_of_df = as_of_df.droplevel("as_of_date")
-
-            # --- Loop over diseases
-            for disease_code in data.disease_codes:
-                # disease_name = DISEASE_CODE3_TO_NAME[disease_code]
-                hosp_colname = params.hosp_colname_fmt.format(disease_code)
-                fig = fig_dict[disease_code]
-
-                plot_sr = as_of_df[hosp_colname].sort_index()
-                fig.add_scatter(
-                    x=plot_sr.index,
-                    y=plot_sr,
-                    name=as_of_date.date().isoformat(),
-                    visible=start_visible,
-                    zorder=-i_as_of,
-                )
-
-            # Track the traces belonging to this jurisdiction
-            data.jur_trace_indices[jur_abbrev].append(i_trace)
-            i_trace += 1
+            plot_sr = as_of_sr.droplevel("as_of_date").sort_index()
+
+            # Reduce the history embedded in the page, keep the full one apart
+            if params.trace_history_mode != "full":
+                full_series[jur_abbrev].append(_series_to_json_dict(plot_sr))
+                plot_sr = _reduce_trace_history(plot_sr, params)
+
+            fig.add_scatter(
+                x=plot_sr.index,
+                y=plot_sr,
+                name=as_of_date.date().isoformat(),
+                visible=start_visible,
+                zorder=-i_as_of,
+            )
+
+    # --- Nowcast traces, in the same jurisdiction order
+    if nowcast_df is not None:
+        for jur_abbrev in sorted(hosp_sr.index.get_level_values("jurisdiction").unique()):
+            _add_nowcast_traces(
+                fig, nowcast_df.loc[nowcast_df["jurisdiction"] == jur_abbrev],
+                visible=(jur_abbrev == params.show_default_jurisd),
+                interval=params.nowcast_interval,
+            )
 
     # Configure plots
     # ===================
-    _LOGGER.info("Configuring plots")
-    num_traces = i_trace
-
-    # # --- Loop over jurisdictions to build its dropdown
-    # jur_buttons = list()
-    # for i_jur, (jur_abbrev, trace_indices) in enumerate(data.jur_trace_indices.items()):
-    #     # # Report progress
-    #     # if i_jur % 10 == 0:
-    #     #     _LOGGER.info(f"Configuring jurisdiction {jur_abbrev} ({i_jur} / {num_jurisdictions})")
-    #
-    #     # Define the button, set all traces as invisible
-    #     button = dict(
-    #         label=jur_abbrev,
-    #         method="update",
-    #         args=[{"visible": np.zeros(num_traces, dtype=bool)}],
-    #     )
-    #     # Set selected traces as visible
-    #     button["args"][0]["visible"][trace_indices] = True
-    #
-    #     # Store, ensuring the default comes first
-    #     if jur_abbrev == params.show_default_jurisd:
-    #         jur_buttons.insert(0, button)
-    #     else:
-    #         jur_buttons.append(button)
-    #
-    # # --- Setup selection dropdowns
-    # for fig in fig_dict.values():
-    #     fig.update_layout(
-    #         updatemenus=[
-    #             # --- Jurisdiction selection
-    #             dict(
-    #                 buttons=jur_buttons,
-    #                 name="Jurisdiction"
-    #             )
-    #         ],
-    #     )
+    _LOGGER.info(f"[{disease_code}] Configuring plot")
+
+    # NOTE: the jurisdiction dropdowns are built in `simple_report_scripts.js`,
+    # from the trace indices exported in `aux_data.js`.
 
     # --- Setup other options
-    max_date = data.main_archive_df.index.get_level_values("weekendingdate").max()
-    for fig in fig_dict.values():
-        fig.update_xaxes(
-            range=[params.plot_date_lim_left, max_date],
-        )
-        fig.update_layout(
-            showlegend=True,
-            legend=dict(
-                orientation="h",
-                y=1.2
-            ),
-            margin=dict(l=0, r=0, t=60, b=40),
-            autosize=False,
-            minreducedwidth=400,
-            width=800,
-            height=600,
-            paper_bgcolor="hsla(187, 36%, 95%, 0)",
-            # plot_bgcolor="hsl(187, 36%, 95%)",
-        )
-        fig.update_xaxes(automargin=True)
-        fig.update_yaxes(automargin=True)
+    fig.update_xaxes(
+        range=[params.plot_date_lim_left, max_date],
+    )
+    fig.update_layout(
+        showlegend=True,
+        legend=dict(
+            orientation="h",
+            y=1.2
+        ),
+        margin=dict(l=0, r=0, t=60, b=40),
+        autosize=False,
+        minreducedwidth=400,
+        width=800,
+        height=600,
+        paper_bgcolor="hsla(187, 36%, 95%, 0)",
+        # plot_bgcolor="hsl(187, 36%, 95%)",
+    )
+    fig.update_xaxes(automargin=True)
+    fig.update_yaxes(automargin=True)
 
-    # Export figure HTML into the template filling contents
+    # Export figure HTML
     # ==============
-    _LOGGER.info("Exporting plots to HTML...")
-    for code, fig in fig_dict.items():
-        data.template_fill_dict[f"{code}_fig"] = fig.to_html(
-            full_html=False, include_plotlyjs=False,
-            div_id=f"{code}-fig-div",
-        )
-        _LOGGER.info(f" - Exported plot for `{code}`")
+    _LOGGER.info(f"[{disease_code}] Exporting plot to HTML...")
+    fig_html = fig.to_html(
+        full_html=False, include_plotlyjs=False,
+        div_id=f"{disease_code}-fig-div",
+    )
+    _LOGGER.info(f" - Exported plot for `{disease_code}`")
+
+    return fig_html, dict(full_series)
+
+
+def _add_nowcast_traces(fig, jur_nowcast_df: pd.DataFrame, visible: bool, interval: float):
+    """Add the uncertainty band (two traces) and the median of the
+    nowcast of one jurisdiction to a figure.
+    """
+    jur_nowcast_df = jur_nowcast_df.sort_values("weekendingdate")
+    x = jur_nowcast_df["weekendingdate"]
+    band_name = f"Nowcast ({interval:.0%} band)"
+
+    fig.add_scatter(
+        x=x, y=jur_nowcast_df["lower"], name=band_name, visible=visible,
+        mode="lines", line=dict(width=0), showlegend=False,
+        legendgroup="nowcast", hoverinfo="skip",
+    )
+    fig.add_scatter(
+        x=x, y=jur_nowcast_df["upper"], name=band_name, visible=visible,
+        mode="lines", line=dict(width=0), fill="tonexty",
+        fillcolor="rgba(100, 100, 100, 0.25)", legendgroup="nowcast",
+    )
+    fig.add_scatter(
+        x=x, y=jur_nowcast_df["median"], name="Nowcast (median)", visible=visible,
+        mode="lines+markers", line=dict(color="black", dash="dash"),
+        legendgroup="nowcast", zorder=1,
+    )
+
+
+def _reduce_trace_history(plot_sr: pd.Series, params: Params) -> pd.Series:
+    """Select the part of a trace's history that is embedded in the page."""
+    import pandas as pd
+
+    in_window = plot_sr.index >= params.trace_window_left
+    if params.trace_history_mode == "window":
+        return plot_sr.loc[in_window]
+    elif params.trace_history_mode == "decimate":
+        older_sr = plot_sr.loc[~in_window]
+        # Count from the end of the older part, so that it meets the window
+        older_sr = older_sr.iloc[::-1].iloc[::params.trace_decimate_step].iloc[::-1]
+        return pd.concat([older_sr, plot_sr.loc[in_window]])
+    else:
+        raise ValueError(
+            f"Unrecognized value for `trace_history_mode`: {params.trace_history_mode}")
+
+
+def _series_to_json_dict(plot_sr: pd.Series) -> dict:
+    return dict(
+        x=plot_sr.index.strftime("%Y-%m-%d").tolist(),
+        # NaN is not valid JSON; missing values are exported as null
+        y=plot_sr.astype(object).where(plot_sr.notna(), None).tolist(),
+    )
 
 
 def fill_templates(params: Params, data: Data):
@@ -284,11 +565,13 @@ def fill_templates(params: Params, data: Data):
 
     # Fill other metadata
     # =============
-    data.template_fill_dict["report_date"] = pd.Timestamp.now().date().isoformat()
+    data.template_fill_dict["report_date"] = datetime.now().date().isoformat()
 
     # ===============
 
     _LOGGER.info(f"Loading templates from directory: {params.templates_dir}")
+    import jinja2
+
     env = jinja2.Environment(loader=jinja2.FileSystemLoader(params.templates_dir))
 
     template = env.get_template("simple_report.html")
@@ -301,38 +584,42 @@ def fill_templates(params: Params, data: Data):
 
 
 def export_all(params: Params, data: Data):
+    """Publish the site into the build directory. See `utils/site_publish.py`:
+    the files are rendered into a staging directory that replaces the
+    build directory at the end, and files that did not change since the
+    last build are not written again.
+    """
     _LOGGER.info("Exporting site files")
-
-    # --- Check and warn about content overwriting
-    if not params.pages_build_dir.is_dir() or not any(params.pages_build_dir.iterdir()):
-        _LOGGER.debug(f"Export directory is empty: {params.pages_build_dir}")
-    else:
-        _LOGGER.warning(f"Export directory is not empty. Files will be overwritten: {params.pages_build_dir}")
-        # --- Clear the export directory
-        for f in params.pages_build_dir.iterdir():
-            if f.is_file():
-                f.unlink()
-            elif f.is_dir():
-                shutil.rmtree(f)
-
-    # --- Copy relevant files
-    files_to_copy = [
-        params.templates_dir / "simple_report_style.css",
-        params.templates_dir / "simple_report_scripts.js",
-    ]
-    for f in files_to_copy:
-        shutil.copy(f, params.pages_build_dir)
-
-    # --- Export filled template
-    with open(params.pages_build_dir / "index.html", "w") as fp:
-        fp.write(data.index_page_content)
-
-    # --- Export the auxiliary data JS file
-    with open(params.pages_build_dir / "aux_data.js", "w") as fp:
-        fp.write(f"const juristiction_trace_index = {json.dumps(data.jur_trace_indices)}\n")
-        fp.write(f"const disease_codes = {json.dumps(data.disease_codes)}\n")
-
-    _LOGGER.info("Exports completed")
+    site_files = dict()
+
+    # --- Static files
+    for fname in ["simple_report_style.css", "simple_report_scripts.js"]:
+        site_files[fname] = (params.templates_dir / fname).read_bytes()
+
+    # --- Filled template
+    site_files["index.html"] = data.index_page_content
+
+    # --- Full history of the traces, with content-addressed file names
+    full_series_files = defaultdict(dict)
+    for (code, jur_abbrev), content in data.full_series_dict.items():
+        fpath = hashed_path(f"{params.full_series_dir}/{code}/{jur_abbrev}.json", content)
+        full_series_files[code][jur_abbrev] = fpath
+        site_files[fpath] = content
+
+    # --- Auxiliary data JS file
+    site_files["aux_data.js"] = "".join([
+        f"const juristiction_trace_index = {json.dumps(data.jur_trace_indices)}\n",
+        f"const nowcast_trace_index = {json.dumps(data.nowcast_trace_indices)}\n",
+        f"const disease_codes = {json.dumps(data.disease_codes)}\n",
+        f"const trace_history_mode = {json.dumps(params.trace_history_mode)}\n",
+        f"const trace_window_left = {json.dumps(params.trace_window_left.date().isoformat())}\n",
+        f"const full_series_files = {json.dumps(full_series_files)}\n",
+    ])
+
+    changes = publish_site(site_files, params.pages_build_dir)
+    _LOGGER.info(
+        f"Exports completed: {len(changes['added'])} added, {len(changes['changed'])} "
+        f"changed, {len(changes['removed'])} removed, {changes['num_unchanged']} unchanged")
 
 
 if __name__ == "__main__":
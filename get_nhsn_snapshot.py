@@ -1,17 +1,27 @@
-"""Fetch the latest NHSN weekly data and store in the archives"""
+"""Fetch the latest NHSN weekly data and store in the archives
 
+The data is archived by `archive_dataset` (`utils/soda_archiver.py`), as
+with `archive_datasets.py`, which also runs the post-archive hooks of the
+dataset (change summary, aggregates and cube, see
+`utils/archive_hooks.py`).
+
+Metadata-only operations (`--check-only`, `--list-catalog`) do not import
+pandas: the modules that handle the data are only imported when the data
+is fetched.
+"""
 import argparse
-import os
-import shutil
+import sys
+from datetime import datetime
 from pathlib import Path
+from zoneinfo import ZoneInfo
 import warnings
 
-import pandas as pd
-
-from utils.nhsn_data import (
-    fetch_nhsn_hosp_data, choose_data_url_and_get_metadata
+from utils.dataset_registry import get_nhsn_dataset_name, get_nhsn_dataset_spec
+from utils.nhsn_metadata import (
+    choose_data_url_and_get_metadata, get_catalog_updated_at, parse_updated_at,
 )
-from utils.yaml_tools import load_yaml, save_yaml
+from utils.soda_archiver import archive_dataset
+from utils.yaml_tools import load_yaml
 
 
 # ===============
@@ -21,10 +31,10 @@ def main():
     args = parse_args()
 
     # --- Parameters
-    output_dir = Path("./datasets/nhsn_weekly_jurisdiction")
+    output_dir = Path(get_nhsn_dataset_spec("consol")["output_dir"])  # Same for both releases
     # preliminary = args.preliminary
     arg_release: str = args.release
-    now: pd.Timestamp = args.now
+    now: datetime = parse_now(args.now)
     save_latest = args.save_latest
     export: bool = args.export
     update_metadata: bool = args.update_metadata
@@ -36,20 +46,34 @@ def main():
 
     dataset_metadata = load_yaml(output_dir / "metadata.yaml")
 
-    # Decide which data release to fetch and get NHSN metadata
-    url, nhsn_metadata, release = choose_data_url_and_get_metadata(arg_release)
-
-    nhsn_df = fetch_nhsn_hosp_data(
-        request_url=url,
-        parse_dates=True,
-    )
-
-    print(nhsn_df.sort_values("weekendingdate", ascending=False).head())  # WATCHPOINT
+    if args.list_catalog:
+        list_catalog(dataset_metadata)
+        return
 
-    export_outputs(
-        nhsn_metadata, nhsn_df, dataset_metadata, args, now, release,
-        output_dir, export, save_latest, update_metadata
+    # Decide which data release to fetch and get NHSN metadata
+    _, nhsn_metadata, release = choose_data_url_and_get_metadata(arg_release)
+
+    if args.check_only:
+        has_new_data = check_for_new_data(nhsn_metadata, dataset_metadata, release)
+        sys.exit(0 if has_new_data else 1)
+
+    spec = get_nhsn_dataset_spec(release)
+    spec["save_latest"] = save_latest
+    hooks = [hook for hook in spec["post_archive_hooks"]
+             if args.build_cube or hook != "nhsn_cube"]
+
+    result = archive_dataset(
+        get_nhsn_dataset_name(release), spec,
+        now=now,
+        fetch_trigger=args.fetch_trigger,
+        force=args.force,
+        dry_run=not export,
+        metadata=nhsn_metadata,
+        update_catalog=update_metadata,
+        hooks=hooks,
     )
+    if result["status"] == "failed":
+        sys.exit(1)
 
 
 def parse_args():
@@ -57,10 +81,11 @@ def parse_args():
 
     parser.add_argument(
         "--now",
-        type=pd.Timestamp,
-        help="Change the date and time regarded as 'now' by the program."
-             " Defaults to pd.Timestamp.now(tz='America/New_York')",
-        default=pd.Timestamp.now(tz='America/New_York')
+        type=str,
+        help="Change the date and time regarded as 'now' by the program, "
+             "in ISO format. Defaults to the current time in "
+             "America/New_York.",
+        default=None,
     )
 
     parser.add_argument(
@@ -103,70 +128,68 @@ def parse_args():
         default="manual",
     )
 
-    return parser.parse_args()
-
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Fetch the data even if the archive already has this release.",
+    )
 
+    parser.add_argument(
+        "--build-cube",
+        action=argparse.BooleanOptionalAction,
+        help="Whether to rebuild the dense array of the archive "
+             "(`cube/` subdirectory, not versioned) after exporting.",
+        default=True,
+    )
 
-def make_nhsn_file_metadata():
-    """Create an entry in the metadata file for the NHSN data."""  # TODO
+    parser.add_argument(
+        "--check-only",
+        action="store_true",
+        help="Only check whether the selected release has data newer than "
+             "the archive, without fetching it. Exits with status 0 if "
+             "there is new data and 1 otherwise.",
+    )
 
-    # return
+    parser.add_argument(
+        "--list-catalog",
+        action="store_true",
+        help="List the files in the archive catalog and exit.",
+    )
 
+    return parser.parse_args()
 
-def export_outputs(
-        nhsn_metadata: pd.DataFrame,
-        nhsn_df: pd.DataFrame,
-        dataset_metadata: dict,
-        args,
-        now: pd.Timestamp,
-        release: str,
-        output_dir: Path,
-        export: bool,
-        save_latest: bool,
-        update_metadata: bool,
-):
-    if not export:
-        print("EXPORT SKIPPED")
-        return
 
-    # filename = f"nhsn_{now.date().isoformat()}.csv"
-    date_str = pd.Timestamp(nhsn_metadata['updatedAt']).date().isoformat()
-    filename = f"nhsn_{date_str}.csv"
-    arch_fpath = output_dir / filename
-    print(f"Exporting to {arch_fpath}...")
-    if arch_fpath.exists():
-        warnings.warn(f"{arch_fpath} already exists and will be overwritten.")
-    output_dir.mkdir(parents=True, exist_ok=True)
-    nhsn_df.to_csv(arch_fpath, index=False)
-    print("Exporting done.")
-
-    if save_latest:
-        latest_fname = output_dir / f"nhsn_latest.csv"
-        print(f"Exporting to {latest_fname}...")
-        shutil.copy2(
-            src=arch_fpath,
-            dst=latest_fname,
-        )
-        print("Exporting done.")
-
-    if update_metadata:
-        # I'll write everything here because there are many arguments. Then I'll put in a function.
-        entry = dict(
-            filename=filename,
-            fetched_on=now.isoformat(),
-            data_updated_at=nhsn_metadata["updatedAt"],
-            fetch_trigger=args.fetch_trigger,
-            release=release,
-            comments="",
-        )
-
-        # Update general fields
-        dataset_metadata["last_updated"] = now.isoformat()
-
-        print(f"Exporting metadata...")
-        dataset_metadata["files"].append(entry)
-        save_yaml(output_dir / "metadata.yaml", dataset_metadata)
-        print("Exporting done.")
+def parse_now(now_str: str | None) -> datetime:
+    """Time regarded as 'now'. Naive times are taken as America/New_York."""
+    tz = ZoneInfo("America/New_York")
+    if now_str is None:
+        return datetime.now(tz=tz)
+    now = datetime.fromisoformat(now_str)
+    if now.tzinfo is None:
+        now = now.replace(tzinfo=tz)
+    return now
+
+
+def check_for_new_data(nhsn_metadata: dict, dataset_metadata: dict, release: str) -> bool:
+    """Compare the `updatedAt` of a release with the latest one in the catalog."""
+    updated_at = parse_updated_at(nhsn_metadata["updatedAt"])
+    archived_at = get_catalog_updated_at(dataset_metadata).get(release)
+    has_new_data = archived_at is None or updated_at > archived_at
+
+    print(f"Release `{release}` updated at: {updated_at.isoformat()}")
+    print(f"Latest `{release}` in the archive: "
+          f"{archived_at.isoformat() if archived_at is not None else None}")
+    print("New data available." if has_new_data else "No new data.")
+    return has_new_data
+
+
+def list_catalog(dataset_metadata: dict):
+    """Print the files in the archive catalog."""
+    for entry in dataset_metadata["files"]:
+        print(f"{entry['filename']:<24}{entry.get('release', ''):<8}"
+              f"{entry.get('data_updated_at', '')}")
+    print(f"{len(dataset_metadata['files'])} files. "
+          f"Last updated: {dataset_metadata.get('last_updated')}")
 
 
 if __name__ == "__main__":
@@ -87,7 +87,109 @@ function switchToJurisdiction(jurisdiction, diseaseCode) {
     // --- Switch visibility of traces
     console.log(`Switching ${figDivId} to jurisdiction = ${jurisdiction}`)
     Plotly.restyle(figDiv, {visible: false})
-    Plotly.restyle(figDiv, {visible: true}, juristiction_trace_index[jurisdiction])
+    Plotly.restyle(
+        figDiv, {visible: true},
+        juristiction_trace_index[jurisdiction].concat(nowcast_trace_index[jurisdiction] || []),
+    )
+
+    // --- Load the full history if the current view needs it
+    currentJurisdiction[diseaseCode] = jurisdiction
+    if (isRangeOutsideWindow(figDiv.layout.xaxis)) {
+        loadFullHistory(diseaseCode, jurisdiction)
+    }
+}
+
+
+// ==========================================
+// Lazy loading of the full history of the traces
+// ==========================================
+// Unless `trace_history_mode` is "full", the page only embeds the recent
+// part of each trace (after `trace_window_left`). The full history of the
+// jurisdiction being shown is fetched when the user zooms or pans out.
+
+const currentJurisdiction = {}  // Jurisdiction shown in each figure, by disease code
+const fullHistoryLoaded = {}    // Set of jurisdictions with the full history loaded, by disease code
+
+
+function addFullHistoryListeners() {
+    if (typeof trace_history_mode === "undefined" || trace_history_mode === "full") {
+        return
+    }
+
+    for (const disease_code of disease_codes) {
+        currentJurisdiction[disease_code] = "USA"
+        fullHistoryLoaded[disease_code] = new Set()
+
+        let figDiv = document.getElementById(`${disease_code}-fig-div`)
+        if (!figDiv) {
+            console.warn(
+                `Element with id ${disease_code}-fig-div does not exist. 
+                Full history will not be loaded.`
+            )
+            continue
+        }
+
+        figDiv.on("plotly_relayout", function(event) {
+            if (isRangeOutsideWindow(event)) {
+                loadFullHistory(disease_code, currentJurisdiction[disease_code])
+            }
+        })
+    }
+}
+
+window.addEventListener("load", addFullHistoryListeners)
+
+
+function isRangeOutsideWindow(xaxis) {
+    // Accepts either a relayout event or the layout's `xaxis` object
+    if (typeof trace_history_mode === "undefined" || trace_history_mode === "full" || !xaxis) {
+        return false
+    }
+    if (xaxis["xaxis.autorange"] || xaxis.autorange) {
+        return true
+    }
+
+    let left = xaxis["xaxis.range[0]"]
+    if (left === undefined && xaxis["xaxis.range"]) { left = xaxis["xaxis.range"][0] }
+    if (left === undefined && xaxis.range) { left = xaxis.range[0] }
+    if (left === undefined) {
+        return false
+    }
+
+    // ISO dates compare as strings
+    return String(left).slice(0, 10) < trace_window_left
+}
+
+
+function loadFullHistory(diseaseCode, jurisdiction) {
+    if (fullHistoryLoaded[diseaseCode].has(jurisdiction)) {
+        return
+    }
+    fullHistoryLoaded[diseaseCode].add(jurisdiction)
+
+    let figDiv = document.getElementById(`${diseaseCode}-fig-div`)
+    let url = `./${encodeURI(full_series_files[diseaseCode][jurisdiction])}`
+    console.log(`Loading full history from ${url}`)
+
+    fetch(url)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`Request to ${url} failed: ${response.status}`)
+            }
+            return response.json()
+        })
+        .then(series => {
+            // One {x, y} entry per trace of the jurisdiction, in the same order
+            Plotly.restyle(
+                figDiv,
+                {x: series.map(s => s.x), y: series.map(s => s.y)},
+                juristiction_trace_index[jurisdiction],
+            )
+        })
+        .catch(err => {
+            console.error(err)
+            fullHistoryLoaded[diseaseCode].delete(jurisdiction)  // Allow retrying
+        })
 }
 
 
@@ -0,0 +1,357 @@
+"""
+Serve slices of the NHSN archive and the report pages over a local
+HTTP server.
+
+The archive is parsed only once, when the server starts, and kept in
+memory. Many consumers (notebooks, forecasting jobs) can then share the
+same parsed copy instead of each one cloning the repository and reading
+all snapshot files.
+
+Endpoints:
+- /api/catalog: list of the as-of dates available in memory.
+- /api/query: slice of the archive. Query parameters (all optional):
+    - jurisdiction: comma-separated jurisdictions (e.g. "CA,USA").
+    - field: comma-separated NHSN fields (e.g. "totalconfflunewadm").
+    - as_of_start, as_of_end: as-of dates, inclusive.
+    - week_start, week_end: week ending dates, inclusive.
+    - format: "json" (default) or "csv".
+  Slices with more than `--max-rows` rows are refused (status 400), so
+  that the whole archive is never serialized in one response.
+- /api/series: data for the report plots, for one disease and
+  jurisdiction. Query parameters: disease (c19, flu, rsv) and
+  jurisdiction. Returns one {x, y} series per as-of date.
+- Any other path is served from the `pages/` build directory.
+
+Unknown jurisdictions, fields or diseases are answered with status 400.
+Responses are kept in an LRU cache bounded by their total size in bytes.
+
+Example:
+```bash
+python serve_archive.py --port 8000
+curl "http://localhost:8000/api/query?jurisdiction=CA&field=totalconfflunewadm&as_of_start=2025-01-01&format=csv"
+```
+"""
+import argparse
+import functools
+import json
+import logging
+import sys
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from utils.nhsn_data import query_archive
+
+
+_LOGGER = logging.getLogger(__name__)
+_LOGGER.setLevel(logging.INFO)
+_LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+
+_HOSP_COLNAME_FMT = "totalconf{}newadm"  # Formats by the 3-letter disease code
+_DISEASE_CODES = ["c19", "flu", "rsv"]
+_QUERY_FORMATS = ["json", "csv"]
+
+
+def main():
+    args = parse_args()
+
+    _LOGGER.info(f"Loading the archive from {args.dataset_dir}...")
+    archive = ArchiveStore(
+        query_archive(
+            dataset_dir=args.dataset_dir,
+            as_of_range=(args.minimum_as_of_date, None),
+        ),
+        cache_mb=args.cache_mb,
+        max_rows=args.max_rows,
+    )
+    _LOGGER.info(
+        f"Loaded {len(archive.as_of_dates)} snapshots "
+        f"({len(archive.archive_df)} rows).")
+
+    handler_class = functools.partial(
+        ArchiveRequestHandler, archive=archive, directory=str(args.pages_dir))
+
+    with ThreadingHTTPServer((args.host, args.port), handler_class) as server:
+        _LOGGER.info(f"Serving on http://{args.host}:{args.port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            _LOGGER.info("Server stopped")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Address to bind the server to.",
+        default="127.0.0.1",
+    )
+
+    parser.add_argument(
+        "--port", "-p",
+        type=int,
+        help="Port to listen on.",
+        default=8000,
+    )
+
+    parser.add_argument(
+        "--dataset-dir",
+        type=Path,
+        help="Directory of the NHSN archive.",
+        default=Path("./datasets/nhsn_weekly_jurisdiction"),
+    )
+
+    parser.add_argument(
+        "--pages-dir",
+        type=Path,
+        help="Directory with the built report pages.",
+        default=Path("./pages"),
+    )
+
+    parser.add_argument(
+        "--minimum-as-of-date",
+        type=str,
+        help="Earliest as-of date to load into memory. Defaults to all "
+             "snapshots.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cache-mb",
+        type=float,
+        help="Maximum total size (in MB) of the responses kept in the LRU "
+             "cache.",
+        default=256.,
+    )
+
+    parser.add_argument(
+        "--max-rows",
+        type=int,
+        help="Maximum number of rows returned by /api/query. Larger "
+             "slices must be split into narrower queries.",
+        default=200000,
+    )
+
+    return parser.parse_args()
+
+
+class ResponseCache:
+    """Thread-safe LRU cache of responses (content bytes and content
+    type), bounded by the total size of the contents.
+
+    Responses larger than the whole cache are not stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, func):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        # Computed outside the lock, so that other requests are not blocked
+        response = func()
+        size = len(response[0])
+        if size > self.max_bytes:
+            return response
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = response
+                self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, (content, _) = self._entries.popitem(last=False)
+                self.num_bytes -= len(content)
+        return response
+
+
+class ArchiveStore:
+    """In-memory archive, with cached responses to queries.
+
+    The archive data frame is only read after construction, so it can
+    be shared by the threads of the server.
+    """
+    archive_df: pd.DataFrame  # Indexed by (as_of_date, weekendingdate, jurisdiction)
+    as_of_dates: list
+
+    def __init__(self, archive_df: pd.DataFrame, cache_mb=256., max_rows=200000):
+        self.archive_df = archive_df.sort_index()
+        self.as_of_dates = list(
+            self.archive_df.index.get_level_values("as_of_date").unique())
+        self.max_rows = max_rows
+
+        # Level values, kept as arrays for fast row selection
+        self._as_of_values = self.archive_df.index.get_level_values("as_of_date")
+        self._week_values = self.archive_df.index.get_level_values("weekendingdate")
+        self._jur_values = self.archive_df.index.get_level_values("jurisdiction")
+        self.jurisdictions = set(self._jur_values.unique())
+
+        # Responses are cached by their normalized query
+        self.cache = ResponseCache(max_bytes=int(cache_mb * 1024 ** 2))
+
+    def query_response(self, jurisdictions, fields, as_of_range, week_range, fmt):
+        self._check_jurisdictions(jurisdictions)
+        self._check_fields(fields)
+        if fmt not in _QUERY_FORMATS:
+            raise ValueError(f"Unknown format `{fmt}`. Options are: {_QUERY_FORMATS}")
+        return self.cache.get_or_compute(
+            ("query", jurisdictions, fields, as_of_range, week_range, fmt),
+            lambda: self._query_response(
+                jurisdictions, fields, as_of_range, week_range, fmt))
+
+    def series_response(self, disease_code, jurisdiction):
+        if disease_code not in _DISEASE_CODES:
+            raise ValueError(
+                f"Unknown disease `{disease_code}`. Options are: {_DISEASE_CODES}")
+        self._check_fields([_HOSP_COLNAME_FMT.format(disease_code)])
+        self._check_jurisdictions([jurisdiction])
+        return self.cache.get_or_compute(
+            ("series", disease_code, jurisdiction),
+            lambda: self._series_response(disease_code, jurisdiction))
+
+    def _check_jurisdictions(self, jurisdictions):
+        unknown = sorted(set(jurisdictions or []) - self.jurisdictions)
+        if unknown:
+            raise ValueError(f"Unknown jurisdictions: {unknown}")
+
+    def _check_fields(self, fields):
+        unknown = [field for field in fields or [] if field not in self.archive_df.columns]
+        if unknown:
+            raise ValueError(f"Unknown fields: {unknown}")
+
+    def catalog_response(self):
+        content = json.dumps(
+            [date.date().isoformat() for date in self.as_of_dates])
+        return content.encode(), "application/json"
+
+    def select(self, jurisdictions=None, fields=None, as_of_range=(None, None),
+               week_range=(None, None), max_rows=None) -> pd.DataFrame:
+        """Return a slice of the archive. See `query_archive`.
+
+        Raises a ValueError if the slice has more than `max_rows` rows.
+        """
+        mask = np.ones(len(self.archive_df), dtype=bool)
+        if jurisdictions is not None:
+            mask &= self._jur_values.isin(jurisdictions)
+        for values, (start, end) in [
+                (self._as_of_values, as_of_range),
+                (self._week_values, week_range)]:
+            if start is not None:
+                mask &= values >= pd.Timestamp(start)
+            if end is not None:
+                mask &= values <= pd.Timestamp(end)
+
+        num_rows = np.count_nonzero(mask)
+        if max_rows is not None and num_rows > max_rows:
+            raise ValueError(
+                f"The query selects {num_rows} rows, more than the limit of "
+                f"{max_rows}. Narrow it down by jurisdiction, as-of date or "
+                f"week.")
+
+        df = self.archive_df.loc[mask]
+        if fields is not None:
+            df = df.reindex(columns=list(fields))
+        return df
+
+    def _query_response(self, jurisdictions, fields, as_of_range, week_range,
+                        fmt):
+        df = self.select(
+            jurisdictions, fields, as_of_range, week_range, max_rows=self.max_rows)
+        df = df.reset_index()
+        for colname in ["as_of_date", "weekendingdate"]:
+            df[colname] = df[colname].dt.strftime("%Y-%m-%d")
+
+        if fmt == "csv":
+            return df.to_csv(index=False).encode(), "text/csv"
+        return df.to_json(orient="records").encode(), "application/json"
+
+    def _series_response(self, disease_code, jurisdiction):
+        hosp_colname = _HOSP_COLNAME_FMT.format(disease_code)
+        df = self.select(jurisdictions=[jurisdiction], fields=[hosp_colname])
+        df = df.droplevel("jurisdiction")
+
+        series_dict = dict()
+        for as_of_date, as_of_df in df.groupby(by="as_of_date", sort=True):
+            plot_sr = as_of_df[hosp_colname].droplevel("as_of_date").sort_index()
+            series_dict[as_of_date.date().isoformat()] = dict(
+                x=plot_sr.index.strftime("%Y-%m-%d").tolist(),
+                # NaN is not valid JSON; missing values are sent as null
+                y=plot_sr.astype(object).where(plot_sr.notna(), None).tolist(),
+            )
+
+        return json.dumps(series_dict).encode(), "application/json"
+
+
+class ArchiveRequestHandler(SimpleHTTPRequestHandler):
+    """Answers the /api/ endpoints from the in-memory archive and serves
+    other paths as static files (the report pages).
+    """
+
+    def __init__(self, *args, archive: ArchiveStore, **kwargs):
+        self.archive = archive
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if not url.path.startswith("/api/"):
+            return super().do_GET()
+
+        query = parse_qs(url.query)
+        try:
+            if url.path == "/api/catalog":
+                content, content_type = self.archive.catalog_response()
+            elif url.path == "/api/query":
+                content, content_type = self.archive.query_response(
+                    _get_list_param(query, "jurisdiction"),
+                    _get_list_param(query, "field"),
+                    (_get_param(query, "as_of_start"), _get_param(query, "as_of_end")),
+                    (_get_param(query, "week_start"), _get_param(query, "week_end")),
+                    _get_param(query, "format", "json"),
+                )
+            elif url.path == "/api/series":
+                content, content_type = self.archive.series_response(
+                    _get_param(query, "disease", "flu"),
+                    _get_param(query, "jurisdiction", "USA"),
+                )
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND, f"Unknown endpoint: {url.path}")
+                return
+        except (ValueError, KeyError) as err:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(err))
+            return
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _get_param(query: dict, name, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+
+def _get_list_param(query: dict, name):
+    """Comma-separated parameter, as a tuple (hashable, for the cache)."""
+    value = _get_param(query, name)
+    if value is None:
+        return None
+    return tuple(sorted(item for item in value.split(",") if item))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Steps run after a new file is added to an archive (post-archive hooks),
+by `archive_dataset` in `utils/soda_archiver.py`. Both
+`get_nhsn_snapshot.py` and `archive_datasets.py` archive through it, so
+the hooks run the same way for every new file.
+
+The hooks compute derived outputs of the new file. These can be
+recomputed later from the archive, so their errors are reported as
+warnings and do not fail the archiving: the new file is already in the
+catalog when they run.
+
+The hooks of each dataset are listed by name in its `post_archive_hooks`
+(see `utils/dataset_registry.py`), and run in that order:
+- "nhsn_diff_summary": print the changes from the previous vintage
+  (see `utils/nhsn_diff.py`).
+- "nhsn_aggregates": store the aggregates of the new snapshot (see
+  `utils/nhsn_aggregates.py`).
+- "nhsn_cube": rebuild the dense array of the archive (see
+  `build_archive_cube` in `utils/nhsn_data.py`).
+
+Each hook is called with the dataset specification, the catalog entry of
+the new file and the catalog (contents of `metadata.yaml`, already with
+the new entry). Modules that import pandas are only imported by the
+hooks that use them.
+"""
+import warnings
+from pathlib import Path
+
+from utils.nhsn_metadata import get_entry_data_updated_at, parse_updated_at
+
+
+def get_previous_entry(spec: dict, entry: dict, dataset_metadata: dict):
+    """Catalog entry of the previous vintage of a file: the most recently
+    updated file of the same archive (same file prefix), updated before
+    it, that exists. None if there is no such file.
+    """
+    output_dir = Path(spec["output_dir"])
+    updated_at = parse_updated_at(get_entry_data_updated_at(entry))
+
+    result, result_updated_at = None, None
+    for other in dataset_metadata.get("files") or list():
+        if (other["filename"] == entry["filename"]
+                or not other["filename"].startswith(f"{spec['file_prefix']}_")
+                or not (output_dir / other["filename"]).exists()):
+            continue
+        other_updated_at = parse_updated_at(get_entry_data_updated_at(other))
+        if other_updated_at < updated_at and (
+                result is None or other_updated_at >= result_updated_at):
+            result, result_updated_at = other, other_updated_at
+    return result
+
+
+# --- Hooks
+# ------------------
+
+
+def _nhsn_diff_summary(spec: dict, entry: dict, dataset_metadata: dict):
+    from utils.nhsn_diff import print_diff_summary, read_snapshot
+
+    previous = get_previous_entry(spec, entry, dataset_metadata)
+    if previous is None:
+        print("No previous vintage to compare with.")
+        return
+
+    output_dir = Path(spec["output_dir"])
+    print(f"Changes from {previous['filename']} to {entry['filename']}:")
+    print_diff_summary(
+        read_snapshot(output_dir / previous["filename"]),
+        read_snapshot(output_dir / entry["filename"]),
+    )
+
+
+def _nhsn_aggregates(spec: dict, entry: dict, dataset_metadata: dict):
+    from utils.nhsn_aggregates import materialize_aggregates
+
+    materialize_aggregates(spec["output_dir"], filenames=[entry["filename"]], overwrite=True)
+
+
+def _nhsn_cube(spec: dict, entry: dict, dataset_metadata: dict):
+    from utils.nhsn_data import build_archive_cube
+
+    # Built from the catalog, which already has the new entry
+    build_archive_cube(spec["output_dir"])
+
+
+POST_ARCHIVE_HOOKS = {
+    "nhsn_diff_summary": _nhsn_diff_summary,
+    "nhsn_aggregates": _nhsn_aggregates,
+    "nhsn_cube": _nhsn_cube,
+}
+
+
+def run_post_archive_hooks(spec: dict, entry: dict, dataset_metadata: dict, hooks=None) -> list:
+    """Run the post-archive hooks of a new file, in order. `hooks`
+    defaults to the `post_archive_hooks` of the dataset.
+
+    Returns the names of the hooks that failed.
+    """
+    if hooks is None:
+        hooks = spec["post_archive_hooks"]
+
+    failed = list()
+    for name in hooks:
+        print(f"Running post-archive hook `{name}` on {entry['filename']}...")
+        try:
+            POST_ARCHIVE_HOOKS[name](spec, entry, dataset_metadata)
+        except Exception as err:
+            warnings.warn(f"Post-archive hook `{name}` failed on {entry['filename']} "
+                          f"({err.__class__.__name__}: {err}). The file was archived anyway.")
+            failed.append(name)
+    return failed
@@ -0,0 +1,133 @@
+"""
+Registry of the CDC SODA (data.cdc.gov) datasets that are archived.
+
+Each dataset is described by a dictionary with:
+- uuid: SODA identifier of the dataset (e.g. "ua7e-t2fy").
+- fields: Data fields to request. None requests all fields, whose names
+  are then taken from the dataset's view metadata (`columns_url_fmt`).
+- key_columns: Columns that identify a row. They are the first columns
+  of the archived files.
+- order_by: Columns the pages of a request are ordered by (`$order`),
+  which SODA needs for stable paging. Defaults to `key_columns`. It also
+  sets the order of the rows in the archived files.
+- output_dir: Directory of the archive, with its `metadata.yaml` catalog.
+- file_prefix: Archived files are named "{file_prefix}_{date}.csv", with
+  the date of the data update.
+- release: Optional release name, stored in the catalog entries (as the
+  "prelim" and "consol" releases of the NHSN data).
+- date_columns: Columns whose time part is removed when archiving
+  (SODA returns floating timestamps as "YYYY-MM-DDT00:00:00.000").
+- save_latest: Whether to also save a "{file_prefix}_latest.csv" copy.
+- page_size: Number of rows per request.
+- max_concurrency: Maximum number of concurrent requests. Together
+  with `page_size`, it bounds the rows held in memory while fetching.
+- post_archive_hooks: Names of the steps run after each new file is
+  archived (see `utils/archive_hooks.py`).
+
+The archived files are written with LF line ends, with the columns in
+the order above (key columns, then fields) and the rows in the order of
+`order_by`. The older NHSN files, written with pandas from a single
+request, keep the column and row order of the SODA response instead: the
+archive has both layouts, with the same values.
+
+Missing keys take the values in `_DEFAULT_SPEC`. Datasets can be added
+to `DATASET_REGISTRY` here, or listed in a YAML file (same keys, under a
+`datasets` mapping) passed to `load_registry`.
+
+This module does not import pandas.
+"""
+from pathlib import Path
+from typing import Union
+
+from utils.archive_hooks import POST_ARCHIVE_HOOKS
+from utils.nhsn_metadata import (
+    _INTEREST_NHSN_FIELDS, _NHSN_DATA_REQUEST_FMT, _NHSN_METADATA_REQUEST_FMT,
+    _UUID_CONSOLIDATED, _UUID_PRELIMINARY,
+)
+from utils.yaml_tools import load_yaml
+
+
+_SODA_VIEW_REQUEST_FMT = "https://data.cdc.gov/api/views/{uuid}.json"
+
+_DEFAULT_SPEC = dict(
+    fields=None,
+    key_columns=None,
+    order_by=None,
+    release=None,
+    date_columns=list(),
+    save_latest=False,
+    page_size=50000,
+    max_concurrency=2,
+    data_url_fmt=_NHSN_DATA_REQUEST_FMT,  # SODA resource endpoint
+    metadata_url_fmt=_NHSN_METADATA_REQUEST_FMT,
+    columns_url_fmt=_SODA_VIEW_REQUEST_FMT,  # View metadata, with the columns
+    post_archive_hooks=list(),
+)
+
+_NHSN_JURISDICTION_SPEC = dict(
+    fields=_INTEREST_NHSN_FIELDS,
+    key_columns=["weekendingdate", "jurisdiction"],
+    order_by=["jurisdiction", "weekendingdate"],  # Contiguous rows per jurisdiction, for the row index
+    output_dir="datasets/nhsn_weekly_jurisdiction",
+    file_prefix="nhsn",
+    date_columns=["weekendingdate"],
+    save_latest=True,
+    post_archive_hooks=["nhsn_diff_summary", "nhsn_aggregates", "nhsn_cube"],
+)
+
+DATASET_REGISTRY = {
+    "nhsn_consol": dict(
+        _NHSN_JURISDICTION_SPEC, uuid=_UUID_CONSOLIDATED, release="consol"),
+    "nhsn_prelim": dict(
+        _NHSN_JURISDICTION_SPEC, uuid=_UUID_PRELIMINARY, release="prelim"),
+}
+
+_NHSN_RELEASE_TO_DATASET = {
+    "consol": "nhsn_consol",
+    "prelim": "nhsn_prelim",
+}
+
+
+def load_registry(registry_file: Union[str, Path] = None) -> dict:
+    """The registry of datasets, with the defaults filled in. Datasets
+    in `registry_file` (YAML) are added to, or replace, the built-in ones.
+    """
+    registry = dict(DATASET_REGISTRY)
+    if registry_file is not None:
+        registry.update(load_yaml(registry_file)["datasets"])
+
+    result = dict()
+    for name, spec in registry.items():
+        missing = [key for key in ["uuid", "output_dir", "file_prefix"] if key not in spec]
+        if missing:
+            raise ValueError(f"Dataset `{name}` is missing the keys {missing}.")
+        unknown = [hook for hook in spec.get("post_archive_hooks") or [] if hook not in POST_ARCHIVE_HOOKS]
+        if unknown:
+            raise ValueError(
+                f"Dataset `{name}` has unknown post-archive hooks {unknown}. "
+                f"Options are: {list(POST_ARCHIVE_HOOKS)}")
+        result[name] = dict(_DEFAULT_SPEC, **spec)
+    return result
+
+
+def get_dataset_spec(name, registry_file: Union[str, Path] = None) -> dict:
+    """The specification of a registered dataset."""
+    registry = load_registry(registry_file)
+    if name not in registry:
+        raise ValueError(
+            f"Dataset `{name}` is not registered. Options are: {list(registry)}")
+    return registry[name]
+
+
+def get_nhsn_dataset_name(release) -> str:
+    """Registry name of the NHSN jurisdiction data of a release
+    ("prelim" or "consol").
+    """
+    return _NHSN_RELEASE_TO_DATASET[release]
+
+
+def get_nhsn_dataset_spec(release) -> dict:
+    """The specification of the NHSN jurisdiction data of a release
+    ("prelim" or "consol").
+    """
+    return get_dataset_spec(get_nhsn_dataset_name(release))
@@ -0,0 +1,235 @@
+"""
+Derived series (aggregates) computed from each NHSN snapshot.
+
+For each archived snapshot, the following are computed once and stored
+in the `aggregates/` subdirectory of the archive, with the same file name
+plus an `_aggregates` suffix:
+- Rates per 100k inhabitants of the total admission fields
+  (`totalconf*newadm*`), using the populations in
+  `aux_data/us_locations.csv`. Columns are suffixed by `_per100k`.
+- Age-group rollups of the `numconf*newadm*` fields: pediatric (0-17),
+  adults 18-64 and adults 65+.
+- Sums over the HHS regions, as extra rows with jurisdiction
+  "HHS Region 1" ... "HHS Region 10". These are computed from the states,
+  so they are available for all snapshots (recent NHSN releases also
+  have their own "Region N" rows, which are kept as they are).
+
+The stored aggregates can be read with `query_archive(..., aggregates=True)`
+from `utils.nhsn_data`.
+
+To compute the aggregates of all archived snapshots that still lack them:
+```bash
+python -m utils.nhsn_aggregates
+```
+"""
+import argparse
+from pathlib import Path
+from typing import Union
+
+import pandas as pd
+
+from utils.nhsn_data import (
+    _ARCHIVE_DIR, _ARCHIVE_INDEX_FIELDS, get_aggregates_path, load_archive_catalog,
+)
+
+
+_LOCATIONS_PATH = Path("aux_data/us_locations.csv")
+
+# --- Age-group rollups: new group name -> NHSN age groups
+_AGE_GROUP_ROLLUPS = {
+    "ped0to17": ["ped0to4", "ped5to17"],
+    "adult18to64": ["adult18to49", "adult50to64"],
+    "adult65plus": ["adult65to74", "adult75plus"],
+}
+
+# --- States and territories in each HHS region
+_HHS_REGION_MEMBERS = {
+    1: ["CT", "ME", "MA", "NH", "RI", "VT"],
+    2: ["NJ", "NY", "PR", "VI"],
+    3: ["DE", "DC", "MD", "PA", "VA", "WV"],
+    4: ["AL", "FL", "GA", "KY", "MS", "NC", "SC", "TN"],
+    5: ["IL", "IN", "MI", "MN", "OH", "WI"],
+    6: ["AR", "LA", "NM", "OK", "TX"],
+    7: ["IA", "KS", "MO", "NE"],
+    8: ["CO", "MT", "ND", "SD", "UT", "WY"],
+    9: ["AZ", "CA", "HI", "NV", "AS", "GU", "MP"],
+    10: ["AK", "ID", "OR", "WA"],
+}
+_JURISDICTION_TO_HHS_REGION = {
+    jur: f"HHS Region {region}"
+    for region, members in _HHS_REGION_MEMBERS.items()
+    for jur in members
+}
+
+
+def compute_snapshot_aggregates(
+        snapshot_df: pd.DataFrame,
+        locations_data: Union[str, Path, pd.DataFrame] = _LOCATIONS_PATH,
+) -> pd.DataFrame:
+    """Compute the derived series of one snapshot.
+
+    Parameters
+    ----------
+    snapshot_df : pd.DataFrame
+        Snapshot with columns "weekendingdate", "jurisdiction" and the
+        NHSN fields (as read from an archived file).
+    locations_data : Union[str, Path, pd.DataFrame]
+        A path to the locations.csv file or a loaded data frame.
+
+    Returns
+    -------
+    pd.DataFrame
+        Data frame with columns "weekendingdate", "jurisdiction", the
+        age-group rollups and the rates per 100k. Contains the original
+        jurisdictions plus the HHS region sums.
+    """
+    if isinstance(locations_data, (str, Path)):
+        locations_df = pd.read_csv(locations_data)
+    elif isinstance(locations_data, pd.DataFrame):
+        locations_df = locations_data
+    else:
+        raise TypeError(
+            "Parameter `locations_data` must either be a pandas data frame"
+            f" or a path to the locations file, but a {type(locations_data)} "
+            f"was given.")
+
+    df = snapshot_df.loc[:, ~snapshot_df.columns.str.startswith("Unnamed")]
+    df = df.set_index(_ARCHIVE_INDEX_FIELDS)
+    df = df.apply(pd.to_numeric, errors="coerce")
+
+    # Age-group rollups
+    # ==================
+    agg_df = pd.DataFrame(index=df.index)
+    for disease in ["c19", "flu", "rsv"]:
+        for group, members in _AGE_GROUP_ROLLUPS.items():
+            member_cols = [f"numconf{disease}newadm{age}" for age in members]
+            member_df = df.reindex(columns=member_cols)
+            # min_count: NaN if none of the groups was reported
+            agg_df[f"numconf{disease}newadm{group}"] = member_df.sum(axis=1, min_count=1)
+
+    total_cols = [col for col in df.columns if col.startswith("totalconf")]
+    agg_df[total_cols] = df[total_cols]
+
+    # HHS region sums, appended as extra jurisdictions
+    # ==================
+    region_sr = agg_df.index.get_level_values("jurisdiction").map(_JURISDICTION_TO_HHS_REGION)
+    has_region = region_sr.notna()
+    region_df = agg_df.loc[has_region].groupby(
+        [agg_df.index.get_level_values("weekendingdate")[has_region],
+         region_sr[has_region].rename("jurisdiction")],
+    ).sum(min_count=1)
+    agg_df = pd.concat([agg_df, region_df])
+
+    # Rates per 100k, from a vectorized join on the populations
+    # ==================
+    population_sr = locations_df.set_index("abbreviation")["population"]
+    population_sr = population_sr.rename({"US": "USA"})  # Matches the NHSN jurisdiction
+    region_pop_sr = population_sr.groupby(_JURISDICTION_TO_HHS_REGION).sum()
+    population_sr = pd.concat([
+        population_sr,
+        region_pop_sr,
+        region_pop_sr.rename(lambda name: name.replace("HHS ", "")),  # NHSN's own region rows
+    ])
+
+    population = agg_df.index.get_level_values("jurisdiction").map(population_sr).to_numpy(dtype=float)
+    for col in total_cols:
+        agg_df[f"{col}_per100k"] = agg_df[col].to_numpy() / population * 1E5
+
+    agg_df = agg_df.drop(columns=total_cols)
+    return agg_df.sort_index().reset_index()
+
+
+def materialize_aggregates(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        filenames=None,
+        locations_data: Union[str, Path, pd.DataFrame] = _LOCATIONS_PATH,
+        overwrite=False,
+) -> list:
+    """Compute and store the aggregates of archived snapshots.
+
+    Parameters
+    ----------
+    dataset_dir : Union[str, Path]
+        Directory of the archive.
+    filenames : list, optional
+        Snapshot files to process. Defaults to all files in the catalog.
+    locations_data : Union[str, Path, pd.DataFrame]
+        A path to the locations.csv file or a loaded data frame.
+    overwrite : bool
+        Whether to recompute aggregates that already exist.
+
+    Returns
+    -------
+    list
+        Paths of the aggregates files written.
+    """
+    dataset_dir = Path(dataset_dir)
+    if filenames is None:
+        catalog_df = load_archive_catalog(dataset_dir)
+        filenames = catalog_df.loc[catalog_df["exists"], "filename"].unique()
+    if isinstance(locations_data, (str, Path)):
+        locations_data = pd.read_csv(locations_data)  # Load once for all files
+
+    written = list()
+    for fname in filenames:
+        out_fpath = get_aggregates_path(fname, dataset_dir)
+        if out_fpath.exists() and not overwrite:
+            continue
+
+        try:
+            snapshot_df = pd.read_csv(dataset_dir / fname)
+        except (FileNotFoundError, pd.errors.ParserError) as err:
+            print(f"Warning: could not read {fname} ({err.__class__.__name__}). Skipping.")
+            continue
+
+        print(f"Exporting aggregates to {out_fpath}...")
+        agg_df = compute_snapshot_aggregates(snapshot_df, locations_data)
+        out_fpath.parent.mkdir(parents=True, exist_ok=True)
+        agg_df.to_csv(out_fpath, index=False, float_format="%.8g")
+        written.append(out_fpath)
+
+    return written
+
+
+# ==========================================================
+
+
+if __name__ == "__main__":
+
+    def parse_args():
+        parser = argparse.ArgumentParser(
+            usage="Compute the aggregates of the archived NHSN snapshots.",
+        )
+        parser.add_argument(
+            "--dataset-dir",
+            type=Path,
+            help="Directory of the archive.",
+            default=_ARCHIVE_DIR,
+        )
+
+        parser.add_argument(
+            "--locations-file",
+            type=Path,
+            help="Path to the locations file, with the populations.",
+            default=_LOCATIONS_PATH,
+        )
+
+        parser.add_argument(
+            "--overwrite",
+            action=argparse.BooleanOptionalAction,
+            help="Whether to recompute existing aggregates.",
+            default=False,
+        )
+
+        return parser.parse_args()
+
+
+    def main():
+        args = parse_args()
+        written = materialize_aggregates(
+            args.dataset_dir, locations_data=args.locations_file,
+            overwrite=args.overwrite,
+        )
+        print(f"{len(written)} aggregates files exported.")
+
+    main()
@@ -0,0 +1,342 @@
+"""
+Recover missing vintages of the archive from the git history of
+`nhsn_latest.csv`.
+
+Every run of `get_nhsn_snapshot.py` overwrites `nhsn_latest.csv`, so
+the past versions of this file in the repository history are snapshots
+of the NHSN data, some of which may be missing from the archive. This
+tool recovers them without checking out any commit:
+1. The commits that changed `nhsn_latest.csv` are listed with
+   `git log`, and the blobs of `nhsn_latest.csv` and `metadata.yaml` at
+   each commit are resolved with a single `git cat-file --batch-check`.
+2. Blobs are deduplicated by hash, and against the files already in the
+   archive (hashed with `git hash-object`).
+3. The remaining blobs are read with a single `git cat-file --batch`
+   and parsed in parallel worker processes, to check that they are
+   valid snapshots.
+4. The vintage of each blob (update time and release) is taken from the
+   last catalog entry of `metadata.yaml` at the same commit, which is the
+   one written together with `nhsn_latest.csv`. Vintages that are not in
+   the archive yet are written to it and added to the catalog.
+
+Example:
+```bash
+python -m utils.nhsn_backfill --dry-run
+```
+"""
+import argparse
+import hashlib
+import io
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Union
+
+import pandas as pd
+import yaml
+
+from utils.nhsn_data import (
+    _ARCHIVE_DIR, _ARCHIVE_INDEX_FIELDS, _ARCHIVE_METADATA_FNAME,
+    get_entry_data_updated_at,
+)
+from utils.nhsn_metadata import parse_updated_at
+from utils.yaml_tools import load_yaml, save_yaml
+
+
+_LATEST_FNAME = "nhsn_latest.csv"
+_BACKFILL_FETCH_TRIGGER = "backfill_git"
+
+
+# --- Git plumbing
+# ------------------
+
+
+def _run_git(args, repo_dir, input_bytes=None) -> bytes:
+    result = subprocess.run(
+        ["git", "-C", str(repo_dir)] + args,
+        input=input_bytes, capture_output=True, check=True,
+    )
+    return result.stdout
+
+
+def _resolve_blobs(repo_dir, object_names) -> list:
+    """Resolve object names (e.g. "<commit>:<path>") into blob hashes,
+    with one `git cat-file --batch-check` call. Missing objects are None.
+    """
+    stdin = "".join(f"{name}\n" for name in object_names).encode()
+    lines = _run_git(["cat-file", "--batch-check"], repo_dir, stdin).decode().splitlines()
+
+    result = list()
+    for line in lines:
+        parts = line.split()
+        result.append(parts[0] if len(parts) == 3 and parts[1] == "blob" else None)
+    return result
+
+
+def _read_blobs(repo_dir, blob_hashes) -> dict:
+    """Read the contents of blobs with one `git cat-file --batch` call."""
+    stdin = "".join(f"{blob}\n" for blob in blob_hashes).encode()
+    output = _run_git(["cat-file", "--batch"], repo_dir, stdin)
+
+    # Output: "<hash> <type> <size>\n<contents>\n" for each object
+    contents = dict()
+    pos = 0
+    for blob in blob_hashes:
+        header_end = output.index(b"\n", pos)
+        obj_hash, _, size = output[pos:header_end].decode().split()
+        start = header_end + 1
+        contents[obj_hash] = output[start:start + int(size)]
+        pos = start + int(size) + 1
+    return contents
+
+
+def list_latest_file_versions(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        rev="--all",
+) -> pd.DataFrame:
+    """List the versions of `nhsn_latest.csv` in the git history.
+
+    Returns a data frame with one row per commit that changed the file,
+    from the oldest to the newest, with columns "commit", "commit_date",
+    "latest_blob" and "metadata_blob" (blob hashes of `nhsn_latest.csv`
+    and of the metadata file at that commit).
+    """
+    dataset_dir = Path(dataset_dir).resolve()
+    repo_dir = Path(_run_git(["rev-parse", "--show-toplevel"], dataset_dir).decode().strip())
+    rel_dir = dataset_dir.relative_to(repo_dir).as_posix()
+    latest_path = f"{rel_dir}/{_LATEST_FNAME}"
+    metadata_path = f"{rel_dir}/{_ARCHIVE_METADATA_FNAME}"
+
+    log = _run_git(
+        ["log", "--reverse", "--format=%H %cI", rev, "--", latest_path], repo_dir,
+    ).decode().split()
+    commits, commit_dates = log[0::2], log[1::2]
+
+    blobs = _resolve_blobs(
+        repo_dir,
+        [f"{commit}:{path}" for commit in commits for path in [latest_path, metadata_path]],
+    )
+
+    return pd.DataFrame({
+        "commit": commits,
+        "commit_date": commit_dates,
+        "latest_blob": blobs[0::2],
+        "metadata_blob": blobs[1::2],
+    })
+
+
+# --- Parsing
+# ------------------
+
+
+def _parse_snapshot_blob(contents: bytes) -> dict:
+    """Check that the contents of a blob are a valid snapshot. Runs in
+    the worker processes.
+    """
+    try:
+        df = pd.read_csv(io.BytesIO(contents))
+    except (pd.errors.ParserError, pd.errors.EmptyDataError) as err:
+        return dict(ok=False, error=err.__class__.__name__)
+
+    missing = [field for field in _ARCHIVE_INDEX_FIELDS if field not in df.columns]
+    if missing or len(df) == 0:
+        return dict(ok=False, error=f"missing columns {missing}" if missing else "no rows")
+
+    weeks = pd.to_datetime(df["weekendingdate"], errors="coerce")
+    return dict(ok=True, num_rows=len(df), last_week=weeks.max().date().isoformat())
+
+
+def _get_vintage_entry(metadata_contents: bytes):
+    """Catalog entry of the snapshot written together with
+    `nhsn_latest.csv`: the last entry of the metadata at the same commit.
+    """
+    if metadata_contents is None:
+        return None
+    files = (yaml.safe_load(metadata_contents) or dict()).get("files") or list()
+    return files[-1] if len(files) > 0 else None
+
+
+# --- Backfill
+# ------------------
+
+
+def backfill_from_git(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        rev="--all",
+        max_workers=None,
+        dry_run=False,
+) -> list:
+    """Insert the vintages found in the git history of `nhsn_latest.csv`
+    that are missing from the archive. See the module docstring.
+
+    Parameters
+    ----------
+    dataset_dir : Union[str, Path]
+        Directory of the archive, inside a git repository.
+    rev : str
+        Revisions whose history is searched. Defaults to all refs.
+    max_workers : int, optional
+        Number of worker processes used to parse the blobs.
+    dry_run : bool
+        If True, only report the vintages that would be inserted.
+
+    Returns
+    -------
+    list
+        The catalog entries inserted (or that would be inserted).
+    """
+    dataset_dir = Path(dataset_dir)
+    repo_dir = dataset_dir.resolve()
+    versions_df = list_latest_file_versions(dataset_dir, rev=rev)
+    print(f"{len(versions_df)} commits changed {_LATEST_FNAME}.")
+
+    # Dedup by content: keep the first commit of each blob, and skip blobs
+    # identical to a file already in the archive
+    # ==================
+    versions_df = versions_df.dropna(subset=["latest_blob"])
+    versions_df = versions_df.drop_duplicates(subset="latest_blob", keep="first")
+
+    archived_fpaths = sorted(
+        fpath for fpath in dataset_dir.glob("nhsn_*.csv") if fpath.name != _LATEST_FNAME)
+    stdin = "".join(f"{fpath.resolve()}\n" for fpath in archived_fpaths).encode()
+    archived_blobs = set(
+        _run_git(["hash-object", "--stdin-paths"], repo_dir, stdin).decode().split())
+    versions_df = versions_df.loc[~versions_df["latest_blob"].isin(archived_blobs)]
+    print(f"{len(versions_df)} distinct versions are not in the archive.")
+
+    if len(versions_df) == 0:
+        return list()
+
+    # Read all blobs at once and parse them in parallel
+    # ==================
+    metadata_blobs = versions_df["metadata_blob"].dropna().unique().tolist()
+    contents = _read_blobs(repo_dir, versions_df["latest_blob"].tolist() + metadata_blobs)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed_list = list(executor.map(
+            _parse_snapshot_blob,
+            [contents[blob] for blob in versions_df["latest_blob"]],
+        ))
+
+    # Match each version with its vintage and insert the missing ones
+    # ==================
+    dataset_metadata = load_yaml(dataset_dir / _ARCHIVE_METADATA_FNAME)
+    catalog = dataset_metadata["files"]
+    archived_fnames = {fpath.name for fpath in archived_fpaths}
+
+    inserted = list()
+    for row, parsed in zip(versions_df.itertuples(), parsed_list):
+        short_commit = row.commit[:7]
+        if not parsed["ok"]:
+            print(f"Warning: {_LATEST_FNAME} at {short_commit} is not a valid "
+                  f"snapshot ({parsed['error']}). Skipping.")
+            continue
+
+        vintage_entry = _get_vintage_entry(contents.get(row.metadata_blob))
+        if vintage_entry is None:
+            print(f"Warning: no catalog entry found for {_LATEST_FNAME} at "
+                  f"{short_commit}. Skipping.")
+            continue
+
+        data_updated_at = get_entry_data_updated_at(vintage_entry)
+        date_str = parse_updated_at(data_updated_at).date().isoformat()
+        filename = f"nhsn_{date_str}.csv"
+        if filename in archived_fnames:
+            continue  # Same vintage, already archived (e.g. re-exported)
+
+        entry = dict(
+            filename=filename,
+            fetched_on=vintage_entry.get("fetched_on", row.commit_date),
+            data_updated_at=data_updated_at,
+            fetch_trigger=_BACKFILL_FETCH_TRIGGER,
+            release=vintage_entry.get("release"),
+            comments=f"Recovered from the git history of {_LATEST_FNAME} "
+                     f"(commit {short_commit}).",
+            sha256=hashlib.sha256(contents[row.latest_blob]).hexdigest(),
+            num_rows=parsed["num_rows"],
+        )
+        print(f"{'DRY RUN: ' if dry_run else ''}Recovering {filename} from "
+              f"{short_commit} ({parsed['num_rows']} rows, last week {parsed['last_week']}).")
+        archived_fnames.add(filename)
+        inserted.append(entry)
+
+        if dry_run:
+            continue
+
+        with open(dataset_dir / filename, "wb") as fp:
+            fp.write(contents[row.latest_blob])
+
+        # A catalog entry may exist for a file that went missing
+        if not any(existing["filename"] == filename for existing in catalog):
+            _insert_catalog_entry(catalog, entry)
+
+    if inserted and not dry_run:
+        print(f"Exporting metadata...")
+        save_yaml(dataset_dir / _ARCHIVE_METADATA_FNAME, dataset_metadata)
+        print("Exporting done.")
+
+    return inserted
+
+
+def _insert_catalog_entry(catalog: list, entry: dict):
+    """Insert an entry before the first one with a later update time, so
+    that the catalog stays in chronological order.
+    """
+    updated_at = parse_updated_at(entry["data_updated_at"])
+    for i, existing in enumerate(catalog):
+        if parse_updated_at(get_entry_data_updated_at(existing)) > updated_at:
+            catalog.insert(i, entry)
+            return
+    catalog.append(entry)
+
+
+# ==========================================================
+
+
+if __name__ == "__main__":
+
+    def parse_args():
+        parser = argparse.ArgumentParser(
+            usage="Recover missing vintages of the archive from the git "
+                  f"history of {_LATEST_FNAME}.",
+        )
+        parser.add_argument(
+            "--dataset-dir",
+            type=Path,
+            help="Directory of the archive.",
+            default=_ARCHIVE_DIR,
+        )
+
+        parser.add_argument(
+            "--rev",
+            type=str,
+            help="Revisions whose history is searched (as in `git log`). "
+                 "Defaults to all refs.",
+            default="--all",
+        )
+
+        parser.add_argument(
+            "--max-workers",
+            type=int,
+            help="Number of worker processes used to parse the blobs.",
+            default=None,
+        )
+
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the vintages that would be recovered.",
+        )
+
+        return parser.parse_args()
+
+
+    def main():
+        args = parse_args()
+        inserted = backfill_from_git(
+            args.dataset_dir, rev=args.rev, max_workers=args.max_workers,
+            dry_run=args.dry_run,
+        )
+        print(f"{len(inserted)} vintages recovered.")
+
+    main()
@@ -15,6 +15,19 @@ If run as a script, it downloads the data and saves it to a CSV file. Example:
 python fetch_data_utils.py --disease covid --locations-file aux_data/locations.csv
 ```
 
+The `query_archive` function reads slices (fields, jurisdictions, as-of
+dates and weeks) of the local archive of NHSN snapshots, opening only the
+files needed to answer the query. Within each file, a row index (byte
+offsets of the rows, see `build_file_index`) is used to read only the
+rows of the requested jurisdictions and weeks.
+
+For numerical work, `build_archive_cube` stores the archive as a dense
+`as_of_date × weekendingdate × jurisdiction × field` array in a NumPy file,
+and `open_archive_cube` memory-maps it. Slices of the cube (e.g. the
+whole revision history of one jurisdiction) are views of the mapped
+file, so they are not read into memory until used, and the pages are
+shared by all processes that open the same cube.
+
 You can also import this module and call the functions directly.
 ```python
 from fetch_data_utils import fetch_nhsn_hosp_data, make_target_data_from_nhsn
@@ -28,38 +41,44 @@ Author: Paulo Cesar Ventura (https://github.com/paulocv, https://paulocv.netlify
 License: MIT
 """
 import argparse
+import io
+import json
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Union
-import requests
 
+import numpy as np
 import pandas as pd
-
-
-# --- Data URLs
-_NHSN_DATA_REQUEST_FMT = "https://data.cdc.gov/resource/{uuid}.json"
-_NHSN_METADATA_REQUEST_FMT = "https://data.cdc.gov/api/views/metadata/v1/{uuid}"
-_UUID_CONSOLIDATED = "ua7e-t2fy"
-_UUID_PRELIMINARY = "mpgq-jmmr"
-
-
-def get_data_url(release):
-    if release in ["prelim", "preliminary"]:
-        return _NHSN_DATA_REQUEST_FMT.format(uuid=_UUID_PRELIMINARY)
-    elif release in ["consol", "consolidated"]:
-        return _NHSN_DATA_REQUEST_FMT.format(uuid=_UUID_CONSOLIDATED)
-    else:
-        raise ValueError(
-            f"Unrecognized value for parameter `release`: {release}")
-
-
-def get_metadata_url(release):
-    if release in ["prelim", "preliminary"]:
-        return _NHSN_METADATA_REQUEST_FMT.format(uuid=_UUID_PRELIMINARY)
-    elif release in ["consol", "consolidated"]:
-        return _NHSN_METADATA_REQUEST_FMT.format(uuid=_UUID_CONSOLIDATED)
-    else:
-        raise ValueError(
-            f"Unrecognized value for parameter `release`: {release}")
+import yaml
+
+# Metadata-only utilities live in a module that does not import pandas.
+# They are imported here to keep them available from this module.
+from utils.nhsn_metadata import (
+    _NHSN_DATA_REQUEST_FMT, _NHSN_METADATA_REQUEST_FMT,
+    _UUID_CONSOLIDATED, _UUID_PRELIMINARY, _INTEREST_NHSN_FIELDS,
+    choose_data_url_and_get_metadata, get_data_url, get_entry_data_updated_at,
+    get_latest_nhsn_url_and_metadata, get_metadata_url,
+    send_and_check_request,
+)
+
+
+# --- Maximum number of rows requested from the NHSN API
+# A snapshot with exactly this number of rows was probably truncated.
+_NHSN_ENTRY_LIMIT = 100000
+
+# --- Local archive of NHSN snapshots
+_ARCHIVE_DIR = Path("datasets/nhsn_weekly_jurisdiction")
+_ARCHIVE_METADATA_FNAME = "metadata.yaml"
+_ARCHIVE_INDEX_FIELDS = ["weekendingdate", "jurisdiction"]
+_INDEX_SUBDIR = "index"  # Row offsets of the snapshots, see `build_file_index`
+_AGGREGATES_SUBDIR = "aggregates"  # Derived series, see `utils/nhsn_aggregates.py`
+_CUBE_SUBDIR = "cube"  # Dense array of the archive, see `build_archive_cube`
+_CUBE_VALUES_FNAME = "values.npy"
+_CUBE_AXES_FNAME = "axes.json"
+_CUBE_AXES = ["as_of_date", "weekendingdate", "jurisdiction", "field"]
 
 
 # --- Conversion from disease names to NHSN new hosp. admission fields
@@ -79,121 +98,12 @@ DISEASE_CODE3_TO_NAME = {
     "rsv": "RSV",
 }
 
-_INTEREST_NHSN_FIELDS = list()
-
-
-# --- Fields to fetch from the NHSN dataset
-# Admissions: TOTALS
-_INTEREST_NHSN_FIELDS += [
-  f"totalconf{disease}newadm{age}"
-      for disease in ["c19", "flu", "rsv"]
-      for age in ["", "adult", "ped"]
- ]
-
-# Admissions: AGE GROUPS
-_INTEREST_NHSN_FIELDS += [
-  f"numconf{disease}newadm{age}"
-      for disease in ["c19", "flu", "rsv"]
-      for age in [
-        "ped0to4", "ped5to17",   # Pediatric
-        "adult18to49", "adult50to64", "adult65to74", "adult75plus",  # Adults
-        "unk",   # Unknown age
-    ]
-]
-
-
-def choose_data_url_and_get_metadata(release):
-    """
-    Choose the appropriate NHSN data URL and retrieve its metadata based on the release type.
-    
-    Parameters
-    ----------
-    release : str
-        The release type to fetch. Options are:
-        - "prelim" or "preliminary": preliminary data release
-        - "consol" or "consolidated": consolidated data release  
-        - "latest": automatically selects the most recently updated release
-        
-    Returns
-    -------
-    tuple
-        A tuple containing (url, metadata_dict, release) where:
-        - url (str): The data request URL for the specified release
-        - metadata_dict (dict): The metadata dictionary from the API
-        - release (str): The normalized release type ("prelim" or "consol")
-        
-    Raises
-    ------
-    ValueError
-        If the release parameter is not one of the recognized values.
-    """
-    if release in ["prelim", "preliminary"]:
-        url = get_data_url("prelim")
-        release = "prelim"
-        metadata_dict = send_and_check_request(get_metadata_url("prelim")).json()
-    elif release in ["consol", "consolidated"]:
-        url = get_data_url("consol")
-        release = "consol"
-        metadata_dict = send_and_check_request(get_metadata_url("consol")).json()
-    elif release in ["latest"]:
-        url, metadata_dict, release = get_latest_nhsn_url_and_metadata()
-    else:
-        raise ValueError(
-            f"Unrecognized value for parameter `release`: {release}")
-
-    return url, metadata_dict, release
-
-
-def get_latest_nhsn_url_and_metadata() -> str:
-    """Determines which release (preliminary or consolidated) of the
-    NHSN data was updated most recently and returns its URL and metadata
-    as a dictionary (parsed from the JSON metadata).
-    """
-    # Querry each dataset for the last updated date
-    prelim_response = send_and_check_request(get_metadata_url("prelim"))
-    prelim_json = prelim_response.json()
-    prelim_date_str = prelim_json["updatedAt"]
-    prelim_date = pd.Timestamp(prelim_date_str)
-
-    consol_response = send_and_check_request(get_metadata_url("consol"))
-    consol_json = consol_response.json()
-    consol_date_str = consol_json["updatedAt"]
-    consol_date = pd.Timestamp(consol_date_str)
-
-    # Pick the latest, return the proper URL
-    if prelim_date > consol_date:
-        return get_data_url("preliminary"), prelim_json, "prelim"
-    else:
-        return get_data_url("consolidated"), consol_json, "consol"
-
-
-def send_and_check_request(request_url, request_params=None) -> requests.Response:
-    print(f"Requesting from {request_url}...")
-    try:
-        response = requests.get(request_url, params=request_params)
-    except requests.exceptions.RequestException as err:
-        raise Exception(
-            f"An error ({err.__class__.__name__}) occurred during the request:\n{str(err)}"
-        )
-
-    try:
-        response.raise_for_status()
-    except requests.exceptions.HTTPError as http_err:
-        raise requests.exceptions.HTTPError(
-            f"An HTTP error occurred: {http_err}\n"
-            f"Response content: {response.text}"
-        )
-    else:
-        print("Request successful")
-
-    return response
-
 
 def fetch_nhsn_hosp_data(
         # as_of: Union[str, pd.Timestamp] = None,  # NHSN doesn't have data history
         # na_rm=False,
         request_url="https://data.cdc.gov/resource/ua7e-t2fy.json",
-        entry_limit=100000,
+        entry_limit=_NHSN_ENTRY_LIMIT,
         parse_dates=True,
         index_fields=None,
         data_fields=None,
@@ -367,6 +277,572 @@ def make_target_data_from_nhsn(
     return df
 
 
+# ==========================================================
+# Queries on the local archive of snapshots
+# ==========================================================
+
+
+def parse_as_of_date(data_updated_at) -> pd.Timestamp:
+    """Convert the `data_updated_at` field of a catalog entry into the
+    as-of date of the snapshot: the date (without time) of the update,
+    in US/Eastern time.
+    """
+    as_of = pd.Timestamp(data_updated_at)
+    if as_of.tzinfo is not None:
+        as_of = as_of.astimezone("US/Eastern").replace(tzinfo=None)
+    return pd.Timestamp(as_of.date())
+
+
+def load_archive_catalog(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        metadata_fname: str = _ARCHIVE_METADATA_FNAME,
+) -> pd.DataFrame:
+    """Load the catalog of archived files (the `files` list of the
+    dataset metadata YAML) as a data frame.
+
+    An `as_of_date` column is added to each entry (see
+    `parse_as_of_date`), as well as an `exists` column telling whether
+    the file is present in the dataset directory. Entries keep the
+    order of the metadata file.
+    """
+    dataset_dir = Path(dataset_dir)
+    with open(dataset_dir / metadata_fname, "r") as fp:
+        dataset_metadata = yaml.load(fp, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+    catalog_df = pd.DataFrame.from_records(dataset_metadata["files"])
+    catalog_df["data_updated_at"] = [
+        get_entry_data_updated_at(entry) for entry in dataset_metadata["files"]]
+    catalog_df["as_of_date"] = catalog_df["data_updated_at"].map(parse_as_of_date)
+    catalog_df["exists"] = catalog_df["filename"].map(
+        lambda fname: (dataset_dir / fname).exists())
+
+    return catalog_df
+
+
+def get_aggregates_path(filename, dataset_dir: Union[str, Path] = _ARCHIVE_DIR) -> Path:
+    """Path of the aggregates file of an archived snapshot."""
+    fname = Path(filename)
+    return Path(dataset_dir) / _AGGREGATES_SUBDIR / f"{fname.stem}_aggregates{fname.suffix}"
+
+
+def get_index_path(fpath) -> Path:
+    """Path of the row index of an archived snapshot."""
+    fpath = Path(fpath)
+    return fpath.parent / _INDEX_SUBDIR / f"{fpath.stem}.npz"
+
+
+def build_file_index(fpath) -> Union[dict, None]:
+    """Build the row index of an archived snapshot and save it in the
+    `index/` subdirectory of the archive.
+
+    The index has the byte offset of each row of the file (`offsets`,
+    with the end of the header first and the end of the file last), and
+    the jurisdiction and week of each row. The size and modification
+    time of the file are stored as well, so that the index is rebuilt
+    if the file changes.
+
+    Returns None if the rows of the file can't be matched to its lines
+    (e.g. blank lines), in which case the file is always read in full.
+    """
+    fpath = Path(fpath)
+    stat = fpath.stat()
+    with open(fpath, "rb") as fp:
+        content = fp.read()
+
+    df = pd.read_csv(io.BytesIO(content), usecols=_ARCHIVE_INDEX_FIELDS)
+    offsets = np.flatnonzero(np.frombuffer(content, dtype=np.uint8) == ord("\n")) + 1
+    if not content.endswith(b"\n"):
+        offsets = np.append(offsets, len(content))
+    if len(offsets) != len(df) + 1:
+        return None
+
+    jur_codes, jur_labels = pd.factorize(df["jurisdiction"])
+    weeks = pd.to_datetime(df["weekendingdate"], format="ISO8601")
+    index = dict(
+        offsets=offsets.astype(np.int64),
+        jurisdiction=jur_codes.astype(np.int16),
+        jurisdiction_labels=np.asarray(jur_labels, dtype=str),
+        week=weeks.to_numpy().astype("datetime64[D]").astype(np.int32),
+        file_size=stat.st_size,
+        file_mtime_ns=stat.st_mtime_ns,
+    )
+
+    # Written under a temporary name, as several threads may build indexes
+    index_path = get_index_path(fpath)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.{id(index)}.tmp")
+    with open(tmp_path, "wb") as fp:
+        np.savez(fp, **index)
+    os.replace(tmp_path, index_path)
+
+    return index
+
+
+def load_file_index(fpath) -> Union[dict, None]:
+    """Load the row index of an archived snapshot, (re)building it if it
+    is missing or out of date. Returns None if the file does not exist or
+    can't be indexed.
+    """
+    fpath = Path(fpath)
+    index_path = get_index_path(fpath)
+    try:
+        stat = fpath.stat()
+        if index_path.exists():
+            with np.load(index_path) as npz:
+                index = {key: npz[key] for key in npz.files}
+            if (index["file_size"] == stat.st_size
+                    and index["file_mtime_ns"] == stat.st_mtime_ns):
+                return index
+        return build_file_index(fpath)
+    except (OSError, ValueError, KeyError, pd.errors.ParserError):
+        return None
+
+
+def _to_epoch_days(date) -> int:
+    """Days since 1970-01-01, as the weeks are stored in the row index."""
+    return (pd.Timestamp(date).normalize() - pd.Timestamp(0)).days
+
+
+def _read_indexed_rows(fpath, index: dict, jurisdictions, week_range) -> bytes:
+    """Read the header and the rows of the requested jurisdictions and
+    weeks of an archived snapshot, using its row index. Consecutive rows
+    are read at once.
+    """
+    mask = np.ones(len(index["week"]), dtype=bool)
+    if jurisdictions is not None:
+        jur_selected = np.isin(index["jurisdiction_labels"], list(jurisdictions))
+        mask &= jur_selected[index["jurisdiction"]]
+    if week_range is not None:
+        start, end = week_range
+        if start is not None:
+            mask &= index["week"] >= _to_epoch_days(start)
+        if end is not None:
+            mask &= index["week"] <= _to_epoch_days(end)
+
+    # Runs of consecutive rows, as [start, end) row positions
+    rows = np.flatnonzero(mask)
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    run_starts = rows[np.r_[0, breaks]] if len(rows) else rows
+    run_ends = rows[np.r_[breaks - 1, len(rows) - 1]] + 1 if len(rows) else rows
+
+    offsets = index["offsets"]
+    with open(fpath, "rb") as fp:
+        chunks = [fp.read(offsets[0])]  # Header
+        for start, end in zip(run_starts, run_ends):
+            fp.seek(offsets[start])
+            chunks.append(fp.read(offsets[end] - offsets[start]))
+    return b"".join(chunks)
+
+
+def _read_archive_file(fpath, fields, jurisdictions, week_range, use_index=False):
+    """Read one archived snapshot, keeping only the requested columns
+    and rows. Returns None if the file is not found or can't be parsed.
+
+    If `use_index` is True, only the rows of the requested jurisdictions
+    and weeks are read from the file (see `load_file_index`).
+    """
+    usecols = set(_ARCHIVE_INDEX_FIELDS)
+    if fields is not None:
+        usecols.update(fields)
+
+    source = fpath
+    if use_index and (jurisdictions is not None or week_range is not None):
+        index = load_file_index(fpath)
+        if index is not None:
+            source = io.BytesIO(_read_indexed_rows(fpath, index, jurisdictions, week_range))
+
+    try:
+        df = pd.read_csv(
+            source,
+            usecols=(lambda c: c in usecols) if fields is not None else None,
+        )
+    except (FileNotFoundError, pd.errors.ParserError) as err:
+        print(f"Warning: could not read {fpath} ({err.__class__.__name__}). "
+              f"Skipping.")
+        return None
+
+    # No rows selected by the index: data columns are numeric, as in the file
+    if source is not fpath and len(df) == 0:
+        df = df.astype({col: float for col in df.columns if col not in _ARCHIVE_INDEX_FIELDS})
+
+    return _filter_archive_df(df, fields, jurisdictions, week_range)
+
+
+def _filter_archive_df(df: pd.DataFrame, fields, jurisdictions, week_range) -> pd.DataFrame:
+    """Apply the row and column filters of a query to a snapshot (or
+    aggregates) data frame, and index it by week and jurisdiction.
+    """
+    # Drop a leftover unnamed index column, present in some early files
+    df = df.loc[:, ~df.columns.str.startswith("Unnamed")]
+
+    # --- Row filters
+    # Dates are parsed only for the rows left by the jurisdiction filter
+    if jurisdictions is not None:
+        df = df.loc[df["jurisdiction"].isin(jurisdictions)]
+    df["weekendingdate"] = pd.to_datetime(df["weekendingdate"])
+
+    mask = pd.Series(True, index=df.index)
+    if week_range is not None:
+        start, end = week_range
+        if start is not None:
+            mask &= df["weekendingdate"] >= pd.Timestamp(start)
+        if end is not None:
+            mask &= df["weekendingdate"] <= pd.Timestamp(end)
+    df = df.loc[mask]
+
+    # Files that do not have some of the requested fields get them as NaN
+    if fields is not None:
+        df = df.reindex(columns=_ARCHIVE_INDEX_FIELDS + list(fields))
+
+    return df.set_index(_ARCHIVE_INDEX_FIELDS)
+
+
+def _read_aggregates_file(fpath, fields, jurisdictions, week_range):
+    """Read the stored aggregates of an archived snapshot. Aggregates that
+    were not stored are computed from the snapshot file. Returns None if
+    neither can be read.
+    """
+    fpath = Path(fpath)
+    agg_fpath = get_aggregates_path(fpath.name, fpath.parent)
+    if agg_fpath.exists():
+        return _read_archive_file(agg_fpath, fields, jurisdictions, week_range)
+
+    from utils.nhsn_aggregates import compute_snapshot_aggregates  # Imports this module
+
+    # All jurisdictions are needed for the HHS region sums
+    snapshot_df = _read_archive_file(fpath, None, None, week_range, use_index=True)
+    if snapshot_df is None:
+        return None
+    agg_df = compute_snapshot_aggregates(snapshot_df.reset_index())
+    return _filter_archive_df(agg_df, fields, jurisdictions, None)
+
+
+def query_archive(
+        fields=None,
+        jurisdictions=None,
+        as_of_range=None,
+        week_range=None,
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        aggregates=False,
+        max_workers=4,
+) -> pd.DataFrame:
+    """Query a slice of the local archive of NHSN snapshots, without
+    loading the whole archive.
+
+    Filters are applied as early as possible: the as-of range is
+    resolved against the catalog (metadata file), so that only the
+    matching snapshot files are opened; only the rows of the requested
+    jurisdictions and weeks are read from each file, using the row index
+    of the file (built on the first query, see `build_file_index`); and
+    only the requested columns are parsed.
+
+    Parameters
+    ----------
+    fields : list, optional
+        NHSN fields (columns) to return, e.g. `["totalconfflunewadm"]`.
+        Defaults to all fields present in the files.
+    jurisdictions : list, optional
+        Jurisdiction abbreviations to return, as in the NHSN data
+        (e.g. `["CA", "USA"]`). Defaults to all jurisdictions.
+    as_of_range : tuple, optional
+        Pair `(start, end)` of as-of dates, both inclusive. Either can
+        be None for an open interval. Defaults to all snapshots.
+    week_range : tuple, optional
+        Pair `(start, end)` of week ending dates, both inclusive. Either
+        can be None for an open interval. Defaults to all weeks.
+    dataset_dir : Union[str, Path]
+        Directory of the archive. Defaults to
+        "datasets/nhsn_weekly_jurisdiction".
+    aggregates : bool
+        If True, the query is made on the precomputed aggregates of the
+        snapshots (rates per 100k, age-group rollups and HHS region
+        sums; see `utils/nhsn_aggregates.py`) instead of the snapshots
+        themselves. Aggregates that were not stored are computed from the
+        snapshots.
+    max_workers : int
+        Number of threads used to read the selected files.
+
+    Returns
+    -------
+    pd.DataFrame
+        A data frame indexed by ("as_of_date", "weekendingdate",
+        "jurisdiction"), with one column per field. As in the report
+        builder, if two snapshots share the same as-of date, only the
+        first one listed in the catalog is kept.
+    """
+    dataset_dir = Path(dataset_dir)
+    if isinstance(fields, str):
+        fields = [fields]
+    if isinstance(jurisdictions, str):
+        jurisdictions = [jurisdictions]
+
+    # Partition pruning: select snapshot files from the catalog
+    # ==================
+    catalog_df = load_archive_catalog(dataset_dir)
+    catalog_df = catalog_df.loc[catalog_df["exists"]]
+    catalog_df = catalog_df.drop_duplicates(subset="as_of_date", keep="first")
+
+    if as_of_range is not None:
+        start, end = as_of_range
+        if start is not None:
+            catalog_df = catalog_df.loc[
+                catalog_df["as_of_date"] >= pd.Timestamp(start)]
+        if end is not None:
+            catalog_df = catalog_df.loc[
+                catalog_df["as_of_date"] <= pd.Timestamp(end)]
+
+    catalog_df = catalog_df.sort_values("as_of_date")
+    fpaths = [dataset_dir / fname for fname in catalog_df["filename"]]
+
+    if aggregates:
+        num_missing = sum(not get_aggregates_path(fname, dataset_dir).exists()
+                          for fname in catalog_df["filename"])
+        if num_missing > 0:
+            print(f"Aggregates of {num_missing} snapshots are not stored. "
+                  f"Computing them from the snapshot files.")
+
+    # Read the selected files, with column and row filters
+    # ==================
+    def read_file(fpath):
+        if aggregates:
+            return _read_aggregates_file(fpath, fields, jurisdictions, week_range)
+        return _read_archive_file(fpath, fields, jurisdictions, week_range, use_index=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        df_list = list(executor.map(read_file, fpaths))
+
+    keys = [key for key, df in zip(catalog_df["as_of_date"], df_list)
+            if df is not None]
+    df_list = [df for df in df_list if df is not None]
+
+    if len(df_list) == 0:
+        index = pd.MultiIndex.from_arrays(
+            [[], [], []], names=["as_of_date"] + _ARCHIVE_INDEX_FIELDS)
+        return pd.DataFrame(index=index, columns=fields)
+
+    return pd.concat(df_list, keys=keys, names=["as_of_date"], axis=0)
+
+
+# ==========================================================
+# Dense array (cube) of the archive
+# ==========================================================
+
+
+def _read_archive_index(fpath):
+    """Read only the index columns of an archived snapshot."""
+    df = _read_archive_file(fpath, [], None, None)
+    return None if df is None else df.index
+
+
+def build_archive_cube(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        fields=None,
+        cube_dir: Union[str, Path] = None,
+        dtype=np.float32,
+        max_workers=4,
+) -> Path:
+    """Write the archive as a dense array with axes (as_of_date,
+    weekendingdate, jurisdiction, field), to be memory-mapped with
+    `open_archive_cube`.
+
+    The array is written to `values.npy` (NumPy format) and the axis
+    labels to `axes.json`, both in `cube_dir`. Cells that are not in a
+    snapshot are NaN. The week axis is a regular weekly range from the
+    first to the last week in the archive, and the jurisdiction axis is
+    sorted. As in `query_archive`, if two snapshots share the same as-of
+    date, only the first one listed in the catalog is kept.
+
+    Both files are written into a temporary directory, which then
+    replaces `cube_dir`, so the values and the axis labels are always
+    from the same build. Processes that have the previous cube mapped
+    keep reading it until they open it again.
+
+    Parameters
+    ----------
+    dataset_dir : Union[str, Path]
+        Directory of the archive.
+    fields : list, optional
+        NHSN fields to store. Defaults to the total admission fields
+        (`totalconf*newadm*`).
+    cube_dir : Union[str, Path], optional
+        Output directory. Defaults to the `cube/` subdirectory of the
+        archive.
+    dtype : np.dtype
+        Data type of the array.
+    max_workers : int
+        Number of threads used to read the files.
+
+    Returns
+    -------
+    Path
+        The output directory.
+    """
+    dataset_dir = Path(dataset_dir)
+    cube_dir = Path(cube_dir) if cube_dir is not None else dataset_dir / _CUBE_SUBDIR
+    if fields is None:
+        fields = [field for field in _INTEREST_NHSN_FIELDS
+                  if field.startswith("totalconf")]
+    fields = list(fields)
+
+    catalog_df = load_archive_catalog(dataset_dir)
+    catalog_df = catalog_df.loc[catalog_df["exists"]]
+    catalog_df = catalog_df.drop_duplicates(subset="as_of_date", keep="first")
+    catalog_df = catalog_df.sort_values("as_of_date")
+    fpaths = [dataset_dir / fname for fname in catalog_df["filename"]]
+
+    # First pass: axis labels, from the index columns only
+    # ==================
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        index_list = list(executor.map(_read_archive_index, fpaths))
+
+    valid = [index is not None and len(index) > 0 for index in index_list]
+    as_of_dates = pd.DatetimeIndex(catalog_df["as_of_date"])[valid]
+    fpaths = [fpath for fpath, is_valid in zip(fpaths, valid) if is_valid]
+    index_list = [index for index, is_valid in zip(index_list, valid) if is_valid]
+    if len(fpaths) == 0:
+        raise ValueError(f"No readable snapshots found in {dataset_dir}.")
+
+    all_weeks = pd.DatetimeIndex(np.concatenate(
+        [index.get_level_values("weekendingdate").unique() for index in index_list]))
+    weeks = pd.date_range(all_weeks.min(), all_weeks.max(), freq="7D")
+    jurisdictions = pd.Index(np.concatenate(
+        [index.get_level_values("jurisdiction").unique() for index in index_list])
+    ).unique().sort_values()
+
+    # Second pass: fill the array, one snapshot at a time
+    # ==================
+    tmp_cube_dir = cube_dir.with_name(f".{cube_dir.name}.{uuid.uuid4().hex}.tmp")
+    tmp_cube_dir.mkdir(parents=True)
+
+    shape = (len(as_of_dates), len(weeks), len(jurisdictions), len(fields))
+    print(f"Writing archive cube of shape {shape} to {cube_dir}...")
+    values = np.lib.format.open_memmap(
+        tmp_cube_dir / _CUBE_VALUES_FNAME, mode="w+", dtype=dtype, shape=shape)
+
+    def fill(i_as_of):
+        df = _read_archive_file(fpaths[i_as_of], fields, None, None)
+        if df is None:  # Changed or removed since the first pass
+            print(f"Warning: {fpaths[i_as_of]} left empty in the cube.")
+            values[i_as_of] = np.nan
+            return
+        i_week = weeks.get_indexer(df.index.get_level_values("weekendingdate"))
+        i_jur = jurisdictions.get_indexer(df.index.get_level_values("jurisdiction"))
+        arr = df.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=dtype)
+
+        snapshot = np.full(shape[1:], np.nan, dtype=dtype)
+        on_grid = i_week >= 0  # Weeks off the weekly grid are dropped
+        snapshot[i_week[on_grid], i_jur[on_grid]] = arr[on_grid]
+        values[i_as_of] = snapshot
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fill, range(len(fpaths))))
+
+    values.flush()
+    del values
+
+    axes = {
+        "as_of_date": [date.date().isoformat() for date in as_of_dates],
+        "weekendingdate": [date.date().isoformat() for date in weeks],
+        "jurisdiction": list(jurisdictions),
+        "field": fields,
+    }
+    with open(tmp_cube_dir / _CUBE_AXES_FNAME, "w") as fp:
+        json.dump(axes, fp, indent=1)
+
+    # Swap the directories. The previous cube is removed last.
+    old_cube_dir = cube_dir.with_name(f".{cube_dir.name}.{uuid.uuid4().hex}.old")
+    if cube_dir.exists():
+        os.rename(cube_dir, old_cube_dir)
+    os.rename(tmp_cube_dir, cube_dir)
+    shutil.rmtree(old_cube_dir, ignore_errors=True)
+    print("Exporting done.")
+
+    return cube_dir
+
+
+class ArchiveCube:
+    """Memory-mapped dense array of the archive, with axes (as_of_date,
+    weekendingdate, jurisdiction, field). Create it with
+    `open_archive_cube`.
+
+    The `values` attribute is the read-only mapped array, and the
+    `labels` attribute has the labels of each axis (as pandas indexes).
+    The `view` method selects cells by label, returning views of the
+    mapped file (no data is copied).
+    """
+
+    def __init__(self, values: np.ndarray, labels: dict):
+        self.values = values
+        self.labels = labels
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def _locate(self, axis, key):
+        """Convert a label, or a slice of labels (both ends inclusive),
+        into a position or a slice of positions along an axis.
+        """
+        index = self.labels[axis]
+        if key is None:
+            return slice(None)
+        if isinstance(key, slice):
+            return index.slice_indexer(key.start, key.stop, key.step)
+        return index.get_loc(key)
+
+    def view(self, as_of_date=None, weekendingdate=None, jurisdiction=None,
+             field=None) -> np.ndarray:
+        """Select cells of the cube by label. Each argument can be a
+        single label, a slice of labels (both ends inclusive) or None for
+        the whole axis. Axes selected by a single label are dropped.
+
+        The result is a view of the mapped file. Use `np.array(...)` to
+        get an in-memory copy.
+        """
+        key = tuple(
+            self._locate(axis, k) for axis, k in zip(
+                _CUBE_AXES, [as_of_date, weekendingdate, jurisdiction, field]))
+        return self.values[key]
+
+    def jurisdiction_history(self, jurisdiction, field=None) -> np.ndarray:
+        """The whole revision history of one jurisdiction, with axes
+        (as_of_date, weekendingdate[, field]).
+        """
+        return self.view(jurisdiction=jurisdiction, field=field)
+
+
+def open_archive_cube(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        cube_dir: Union[str, Path] = None,
+) -> ArchiveCube:
+    """Memory-map the cube written by `build_archive_cube`, without
+    reading it into memory.
+
+    Raises a FileNotFoundError if the cube was not built, and a
+    ValueError if the shape of the values does not match the axis labels.
+    """
+    cube_dir = Path(cube_dir) if cube_dir is not None else Path(dataset_dir) / _CUBE_SUBDIR
+
+    with open(cube_dir / _CUBE_AXES_FNAME, "r") as fp:
+        axes = json.load(fp)
+    labels = {
+        "as_of_date": pd.DatetimeIndex(axes["as_of_date"]),
+        "weekendingdate": pd.DatetimeIndex(axes["weekendingdate"]),
+        "jurisdiction": pd.Index(axes["jurisdiction"]),
+        "field": pd.Index(axes["field"]),
+    }
+    values = np.load(cube_dir / _CUBE_VALUES_FNAME, mmap_mode="r")
+
+    expected_shape = tuple(len(labels[axis]) for axis in _CUBE_AXES)
+    if values.shape != expected_shape:
+        raise ValueError(
+            f"The archive cube in {cube_dir} has shape {values.shape}, but "
+            f"its axis labels have lengths {expected_shape}. Rebuild it "
+            f"with `build_archive_cube`.")
+
+    return ArchiveCube(values, labels)
+
+
 # ==========================================================
 
 
@@ -0,0 +1,321 @@
+"""
+Compare snapshots (vintages) of the NHSN data.
+
+Two snapshots are aligned on (weekendingdate, jurisdiction) and all
+fields are compared at once, as arrays. The result is a compact change
+set, with one row per changed cell:
+- "added": the cell was missing (or NaN) in the old snapshot.
+- "removed": the cell is missing (or NaN) in the new snapshot.
+- "revised": the value changed.
+
+The change set can be applied back to the old snapshot to obtain the
+new one (`apply_diff`), so it can also be stored as a delta.
+
+Example:
+```python
+from utils.nhsn_diff import read_snapshot, diff_snapshots, summarize_diff
+
+old_df = read_snapshot("datasets/nhsn_weekly_jurisdiction/nhsn_2025-01-08.csv")
+new_df = read_snapshot("datasets/nhsn_weekly_jurisdiction/nhsn_2025-01-10.csv")
+change_df = diff_snapshots(old_df, new_df)
+print(summarize_diff(change_df))
+```
+
+To compare every pair of consecutive vintages in the archive:
+```bash
+python -m utils.nhsn_diff --all --output diffs.csv
+```
+"""
+import argparse
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from utils.nhsn_data import (
+    _ARCHIVE_DIR, _ARCHIVE_INDEX_FIELDS, _INTEREST_NHSN_FIELDS,
+    load_archive_catalog,
+)
+
+
+_CHANGE_KINDS = ["added", "removed", "revised"]
+
+
+def read_snapshot(fpath: Union[str, Path], fields=None) -> pd.DataFrame:
+    """Read one snapshot file, indexed by (weekendingdate, jurisdiction),
+    with numeric fields. Defaults to all the fields present in the file.
+    """
+    df = pd.read_csv(fpath)
+    df = df.loc[:, ~df.columns.str.startswith("Unnamed")]  # Old index column
+    df["weekendingdate"] = pd.to_datetime(df["weekendingdate"], format="ISO8601")
+    df = df.set_index(_ARCHIVE_INDEX_FIELDS).sort_index()
+    if fields is not None:
+        df = df.reindex(columns=fields)
+
+    # Only convert the columns that were not parsed as numbers
+    non_numeric = df.columns[[not pd.api.types.is_numeric_dtype(dtype) for dtype in df.dtypes]]
+    if len(non_numeric) > 0:
+        df[non_numeric] = df[non_numeric].apply(pd.to_numeric, errors="coerce")
+    return df
+
+
+def diff_snapshots(
+        old_df: pd.DataFrame,
+        new_df: pd.DataFrame,
+        fields=None,
+        atol=0.,
+) -> pd.DataFrame:
+    """Compute the cell-level changes from one snapshot to another.
+
+    Parameters
+    ----------
+    old_df, new_df : pd.DataFrame
+        Snapshots indexed by (weekendingdate, jurisdiction), as returned
+        by `read_snapshot`.
+    fields : list, optional
+        Fields to compare. Defaults to `_INTEREST_NHSN_FIELDS`. Fields
+        missing from a snapshot are treated as NaN.
+    atol : float
+        Absolute differences up to this value are not reported as
+        revisions.
+
+    Returns
+    -------
+    pd.DataFrame
+        Change set with columns "weekendingdate", "jurisdiction",
+        "field", "change" ("added", "removed" or "revised"),
+        "old_value" and "new_value".
+    """
+    if fields is None:
+        fields = _INTEREST_NHSN_FIELDS
+    fields = list(fields)
+
+    # Align both snapshots on the union of their rows
+    index = old_df.index.union(new_df.index)
+    old_arr = old_df.reindex(index=index, columns=fields).to_numpy(dtype=float)
+    new_arr = new_df.reindex(index=index, columns=fields).to_numpy(dtype=float)
+
+    # Classify all cells at once
+    old_nan = np.isnan(old_arr)
+    new_nan = np.isnan(new_arr)
+    added = old_nan & ~new_nan
+    removed = ~old_nan & new_nan
+    with np.errstate(invalid="ignore"):
+        revised = ~old_nan & ~new_nan & (np.abs(new_arr - old_arr) > atol)
+
+    kind_arr = np.full(old_arr.shape, -1, dtype=np.int8)
+    for i_kind, mask in enumerate([added, removed, revised]):
+        kind_arr[mask] = i_kind
+
+    i_row, i_col = np.nonzero(kind_arr >= 0)
+
+    return pd.DataFrame({
+        "weekendingdate": index.get_level_values("weekendingdate")[i_row],
+        "jurisdiction": index.get_level_values("jurisdiction")[i_row],
+        "field": np.asarray(fields, dtype=object)[i_col],
+        "change": pd.Categorical.from_codes(
+            kind_arr[i_row, i_col], categories=_CHANGE_KINDS),
+        "old_value": old_arr[i_row, i_col],
+        "new_value": new_arr[i_row, i_col],
+    })
+
+
+def apply_diff(old_df: pd.DataFrame, change_df: pd.DataFrame) -> pd.DataFrame:
+    """Apply a change set to the old snapshot, returning the new one.
+
+    Rows that have no values in the new snapshot are left as all-NaN
+    rows, since the change set only records cells.
+    """
+    fields = list(old_df.columns.union(change_df["field"].unique(), sort=False))
+    change_index = pd.MultiIndex.from_arrays(
+        [change_df["weekendingdate"], change_df["jurisdiction"]],
+        names=_ARCHIVE_INDEX_FIELDS,
+    )
+    index = old_df.index.union(change_index.unique())
+
+    new_df = old_df.reindex(index=index, columns=fields)
+    arr = new_df.to_numpy(dtype=float, copy=True)
+    i_row = index.get_indexer(change_index)
+    i_col = pd.Index(fields).get_indexer(change_df["field"])
+    arr[i_row, i_col] = change_df["new_value"].to_numpy()
+
+    return pd.DataFrame(arr, index=index, columns=fields)
+
+
+def summarize_diff(change_df: pd.DataFrame) -> pd.DataFrame:
+    """Summary table of a change set, with one row per field.
+
+    Columns are the number of added, removed and revised cells, and the
+    total and maximum absolute revisions. Extra grouping columns in the
+    change set (e.g. "as_of_date" from `diff_consecutive_vintages`) are
+    kept as index levels.
+    """
+    group_cols = [
+        col for col in change_df.columns
+        if col not in ["weekendingdate", "jurisdiction", "field", "change",
+                       "old_value", "new_value"]
+    ] + ["field"]
+
+    counts_df = (
+        change_df.groupby(group_cols + ["change"], observed=False).size()
+        .unstack("change", fill_value=0)
+        .reindex(columns=_CHANGE_KINDS, fill_value=0)
+    )
+
+    revised_df = change_df.loc[change_df["change"] == "revised"]
+    abs_rev = (revised_df["new_value"] - revised_df["old_value"]).abs()
+    rev_df = abs_rev.groupby([revised_df[col] for col in group_cols]).agg(
+        ["sum", "max"]).rename(columns={
+            "sum": "total_abs_revision", "max": "max_abs_revision"})
+
+    summary_df = counts_df.join(rev_df, how="left")
+    summary_df.columns.name = None
+    return summary_df.fillna({"total_abs_revision": 0., "max_abs_revision": 0.})
+
+
+def compare_coverage(old_df: pd.DataFrame, new_df: pd.DataFrame) -> dict:
+    """Weeks and jurisdictions that appeared or disappeared from one
+    snapshot to another.
+    """
+    result = dict()
+    for level, name in [("weekendingdate", "weeks"), ("jurisdiction", "jurisdictions")]:
+        old_values = old_df.index.get_level_values(level).unique()
+        new_values = new_df.index.get_level_values(level).unique()
+        result[f"new_{name}"] = list(new_values.difference(old_values))
+        result[f"dropped_{name}"] = list(old_values.difference(new_values))
+    return result
+
+
+def print_diff_summary(old_df: pd.DataFrame, new_df: pd.DataFrame, fields=None):
+    """Print an overview of the changes between two snapshots."""
+    change_df = diff_snapshots(old_df, new_df, fields=fields)
+    coverage = compare_coverage(old_df, new_df)
+
+    def fmt(values):
+        return [v.date().isoformat() if isinstance(v, pd.Timestamp) else v
+                for v in values]
+
+    print("Changes from the previous snapshot:")
+    for key, values in coverage.items():
+        print(f" - {key.replace('_', ' ')}: {fmt(values)}")
+    print(f" - cells changed: {change_df['change'].value_counts().to_dict()}")
+
+    summary_df = summarize_diff(change_df)
+    summary_df = summary_df.loc[summary_df[_CHANGE_KINDS].sum(axis=1) > 0]
+    if len(summary_df) > 0:
+        print(summary_df.to_string())
+
+
+def diff_consecutive_vintages(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        fields=None,
+        atol=0.,
+) -> pd.DataFrame:
+    """Compute the change sets between every pair of consecutive
+    vintages in the archive, in as-of date order.
+
+    Each snapshot is read only once. Returns the concatenated change
+    sets, with the extra columns "as_of_date" (of the new vintage) and
+    "previous_as_of_date".
+    """
+    dataset_dir = Path(dataset_dir)
+    if fields is None:
+        fields = _INTEREST_NHSN_FIELDS
+
+    catalog_df = load_archive_catalog(dataset_dir)
+    catalog_df = catalog_df.loc[catalog_df["exists"]]
+    catalog_df = catalog_df.drop_duplicates(subset="as_of_date", keep="first")
+    catalog_df = catalog_df.sort_values("as_of_date")
+
+    change_df_list = list()
+    prev_df, prev_date = None, None
+    for as_of_date, fname in zip(catalog_df["as_of_date"], catalog_df["filename"]):
+        try:
+            df = read_snapshot(dataset_dir / fname, fields=fields)
+        except pd.errors.ParserError:
+            print(f"Warning: {fname} could not be parsed. Skipping.")
+            continue
+
+        if prev_df is not None:
+            change_df = diff_snapshots(prev_df, df, fields=fields, atol=atol)
+            change_df.insert(0, "previous_as_of_date", prev_date)
+            change_df.insert(0, "as_of_date", as_of_date)
+            change_df_list.append(change_df)
+
+        prev_df, prev_date = df, as_of_date
+
+    if len(change_df_list) == 0:
+        return pd.DataFrame(columns=[
+            "as_of_date", "previous_as_of_date", "weekendingdate",
+            "jurisdiction", "field", "change", "old_value", "new_value"])
+
+    return pd.concat(change_df_list, ignore_index=True)
+
+
+# ==========================================================
+
+
+if __name__ == "__main__":
+
+    def parse_args():
+        parser = argparse.ArgumentParser(
+            usage="Compare two NHSN snapshots, or every pair of consecutive "
+                  "vintages in the archive (--all).",
+        )
+        parser.add_argument(
+            "files",
+            type=Path,
+            nargs="*",
+            help="Old and new snapshot files.",
+        )
+
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Compare all consecutive vintages in the archive.",
+        )
+
+        parser.add_argument(
+            "--dataset-dir",
+            type=Path,
+            help="Directory of the archive (used with --all).",
+            default=_ARCHIVE_DIR,
+        )
+
+        parser.add_argument(
+            "--output", "-o",
+            type=Path,
+            help="File to export the change set on (CSV). The summary "
+                 "table is exported next to it, with `_summary` suffix.",
+            default=None,
+        )
+
+        return parser.parse_args()
+
+
+    def main():
+        args = parse_args()
+
+        if args.all:
+            change_df = diff_consecutive_vintages(args.dataset_dir)
+        elif len(args.files) == 2:
+            old_df, new_df = (read_snapshot(fpath) for fpath in args.files)
+            print_diff_summary(old_df, new_df)
+            change_df = diff_snapshots(old_df, new_df)
+        else:
+            raise ValueError("Inform two snapshot files or use --all.")
+
+        summary_df = summarize_diff(change_df)
+        if args.all:
+            print(summary_df.groupby("as_of_date").sum(numeric_only=True).to_string())
+
+        if args.output is not None:
+            print(f"Exporting to {args.output}...")
+            args.output.parent.mkdir(parents=True, exist_ok=True)
+            change_df.to_csv(args.output, index=False)
+            summary_df.to_csv(
+                args.output.with_name(args.output.stem + "_summary.csv"))
+            print("Exporting done.")
+
+    main()
@@ -0,0 +1,189 @@
+"""
+Lightweight utilities to query the metadata of the NHSN datasets.
+
+This module does not import pandas, so that metadata-only operations
+(e.g. checking whether a new release is available) start fast. The
+functions are also available from `utils.nhsn_data`.
+"""
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import requests
+
+
+# --- Data URLs
+_NHSN_DATA_REQUEST_FMT = "https://data.cdc.gov/resource/{uuid}.json"
+_NHSN_METADATA_REQUEST_FMT = "https://data.cdc.gov/api/views/metadata/v1/{uuid}"
+_UUID_CONSOLIDATED = "ua7e-t2fy"
+_UUID_PRELIMINARY = "mpgq-jmmr"
+
+_INTEREST_NHSN_FIELDS = list()
+
+
+# --- Fields to fetch from the NHSN dataset
+# Admissions: TOTALS
+_INTEREST_NHSN_FIELDS += [
+  f"totalconf{disease}newadm{age}"
+      for disease in ["c19", "flu", "rsv"]
+      for age in ["", "adult", "ped"]
+ ]
+
+# Admissions: AGE GROUPS
+_INTEREST_NHSN_FIELDS += [
+  f"numconf{disease}newadm{age}"
+      for disease in ["c19", "flu", "rsv"]
+      for age in [
+        "ped0to4", "ped5to17",   # Pediatric
+        "adult18to49", "adult50to64", "adult65to74", "adult75plus",  # Adults
+        "unk",   # Unknown age
+    ]
+]
+
+
+def get_data_url(release):
+    if release in ["prelim", "preliminary"]:
+        return _NHSN_DATA_REQUEST_FMT.format(uuid=_UUID_PRELIMINARY)
+    elif release in ["consol", "consolidated"]:
+        return _NHSN_DATA_REQUEST_FMT.format(uuid=_UUID_CONSOLIDATED)
+    else:
+        raise ValueError(
+            f"Unrecognized value for parameter `release`: {release}")
+
+
+def get_metadata_url(release):
+    if release in ["prelim", "preliminary"]:
+        return _NHSN_METADATA_REQUEST_FMT.format(uuid=_UUID_PRELIMINARY)
+    elif release in ["consol", "consolidated"]:
+        return _NHSN_METADATA_REQUEST_FMT.format(uuid=_UUID_CONSOLIDATED)
+    else:
+        raise ValueError(
+            f"Unrecognized value for parameter `release`: {release}")
+
+
+def parse_updated_at(value) -> datetime:
+    """Parse an `updatedAt` timestamp (or a `data_updated_at` catalog
+    field) into an aware datetime. Dates without time are taken as
+    midnight UTC.
+    """
+    if isinstance(value, datetime):
+        dt = value
+    elif isinstance(value, date):
+        dt = datetime(value.year, value.month, value.day)
+    else:
+        dt = datetime.fromisoformat(str(value))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def get_entry_data_updated_at(file_entry: dict):
+    """Return the `data_updated_at` field of a catalog entry.
+
+    Some entries were added by hand without this field. For these, the
+    date in the file name (nhsn_YYYY-MM-DD.csv, which is the update date
+    of the data) is returned instead.
+    """
+    data_updated_at = file_entry.get("data_updated_at")
+    if data_updated_at is None:
+        data_updated_at = Path(file_entry["filename"]).stem.split("_")[-1]
+    return data_updated_at
+
+
+def get_catalog_updated_at(dataset_metadata: dict) -> dict:
+    """Latest `data_updated_at` of each release ("prelim", "consol") in
+    the archive catalog (contents of the dataset metadata YAML).
+    """
+    result = dict()
+    for entry in dataset_metadata["files"]:
+        release = entry.get("release")
+        if release not in ["prelim", "consol"] or entry.get("data_updated_at") is None:
+            continue
+        updated_at = parse_updated_at(entry["data_updated_at"])
+        if release not in result or updated_at > result[release]:
+            result[release] = updated_at
+    return result
+
+
+def choose_data_url_and_get_metadata(release):
+    """
+    Choose the appropriate NHSN data URL and retrieve its metadata based on the release type.
+    
+    Parameters
+    ----------
+    release : str
+        The release type to fetch. Options are:
+        - "prelim" or "preliminary": preliminary data release
+        - "consol" or "consolidated": consolidated data release  
+        - "latest": automatically selects the most recently updated release
+        
+    Returns
+    -------
+    tuple
+        A tuple containing (url, metadata_dict, release) where:
+        - url (str): The data request URL for the specified release
+        - metadata_dict (dict): The metadata dictionary from the API
+        - release (str): The normalized release type ("prelim" or "consol")
+        
+    Raises
+    ------
+    ValueError
+        If the release parameter is not one of the recognized values.
+    """
+    if release in ["prelim", "preliminary"]:
+        url = get_data_url("prelim")
+        release = "prelim"
+        metadata_dict = send_and_check_request(get_metadata_url("prelim")).json()
+    elif release in ["consol", "consolidated"]:
+        url = get_data_url("consol")
+        release = "consol"
+        metadata_dict = send_and_check_request(get_metadata_url("consol")).json()
+    elif release in ["latest"]:
+        url, metadata_dict, release = get_latest_nhsn_url_and_metadata()
+    else:
+        raise ValueError(
+            f"Unrecognized value for parameter `release`: {release}")
+
+    return url, metadata_dict, release
+
+
+def get_latest_nhsn_url_and_metadata() -> str:
+    """Determines which release (preliminary or consolidated) of the
+    NHSN data was updated most recently and returns its URL and metadata
+    as a dictionary (parsed from the JSON metadata).
+    """
+    # Querry each dataset for the last updated date
+    prelim_response = send_and_check_request(get_metadata_url("prelim"))
+    prelim_json = prelim_response.json()
+    prelim_date = parse_updated_at(prelim_json["updatedAt"])
+
+    consol_response = send_and_check_request(get_metadata_url("consol"))
+    consol_json = consol_response.json()
+    consol_date = parse_updated_at(consol_json["updatedAt"])
+
+    # Pick the latest, return the proper URL
+    if prelim_date > consol_date:
+        return get_data_url("preliminary"), prelim_json, "prelim"
+    else:
+        return get_data_url("consolidated"), consol_json, "consol"
+
+
+def send_and_check_request(request_url, request_params=None) -> requests.Response:
+    print(f"Requesting from {request_url}...")
+    try:
+        response = requests.get(request_url, params=request_params)
+    except requests.exceptions.RequestException as err:
+        raise Exception(
+            f"An error ({err.__class__.__name__}) occurred during the request:\n{str(err)}"
+        )
+
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as http_err:
+        raise requests.exceptions.HTTPError(
+            f"An HTTP error occurred: {http_err}\n"
+            f"Response content: {response.text}"
+        )
+    else:
+        print("Request successful")
+
+    return response
@@ -0,0 +1,282 @@
+"""
+Empirical correction of the latest, still incomplete weeks of the NHSN
+data (nowcast), from the revision history in the archive.
+
+For each past vintage and each lag (weeks between the week ending date
+and the as-of date), the completeness multiplier is the ratio between
+the value of the week in the latest snapshot, taken as final, and the
+value reported at that lag. Only weeks that are at least `max_lag` weeks
+old in the latest snapshot are used, so that their values have settled.
+The quantiles of the multipliers give the correction of each recent week
+of the latest snapshot and its uncertainty band.
+
+All jurisdictions, diseases and lags are computed at once, as arrays
+over the dense cube of the archive (see `build_archive_cube` in
+`utils/nhsn_data.py`). Multipliers of jurisdictions without enough data
+are taken from all jurisdictions pooled.
+
+Example:
+```python
+from utils.nhsn_nowcast import nowcast_latest
+
+nowcast_df = nowcast_latest()
+print(nowcast_df.loc[nowcast_df["jurisdiction"] == "USA"])
+```
+
+Or, to export the nowcast of the latest snapshot to a CSV file:
+```bash
+python -m utils.nhsn_nowcast --output nowcast.csv
+```
+"""
+import argparse
+import warnings
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from utils.nhsn_data import (
+    _ARCHIVE_DIR, ArchiveCube, build_archive_cube, load_archive_catalog,
+    open_archive_cube,
+)
+
+
+_NOWCAST_FIELDS = ["totalconfc19newadm", "totalconfflunewadm", "totalconfrsvnewadm"]
+
+
+def _get_lag_positions(cube: ArchiveCube, max_lag):
+    """Position in the week axis of each (as-of date, lag) pair, with
+    lag 0 being the last week that ends on or before the as-of date.
+    Positions outside the week axis are -1.
+    """
+    weeks = cube.labels["weekendingdate"]
+    last_week_pos = weeks.searchsorted(cube.labels["as_of_date"], side="right") - 1
+    week_pos = last_week_pos[:, None] - np.arange(max_lag)[None, :]
+    week_pos[week_pos < 0] = -1
+    return week_pos
+
+
+def estimate_completeness(
+        cube: ArchiveCube,
+        fields=None,
+        max_lag=8,
+        max_train_vintages=60,
+        interval=0.9,
+        same_weekday=True,
+) -> pd.DataFrame:
+    """Estimate the completeness multipliers by lag, for all
+    jurisdictions and fields of the cube.
+
+    Parameters
+    ----------
+    cube : ArchiveCube
+        Cube of the archive (see `open_archive_cube`). Its last as-of date
+        is taken as the final data.
+    fields : list, optional
+        Fields to estimate. Defaults to the total admissions of COVID-19,
+        influenza and RSV.
+    max_lag : int
+        Number of lags to correct (0 to `max_lag` - 1). Weeks older than
+        that are taken as complete.
+    max_train_vintages : int, optional
+        Number of most recent vintages used in the estimates. None for all.
+    interval : float
+        Probability mass of the uncertainty band.
+    same_weekday : bool
+        If True, only vintages with the same weekday as the latest one are
+        used, since the preliminary (Wednesday) and consolidated (Friday)
+        releases have different completeness at the same lag.
+
+    Returns
+    -------
+    pd.DataFrame
+        Data frame indexed by ("field", "jurisdiction", "lag"), with
+        columns "lower", "median" and "upper" (quantiles of the
+        multipliers) and "num_samples" (number of observed multipliers,
+        before the fallback to the pooled ones).
+    """
+    if fields is None:
+        fields = _NOWCAST_FIELDS
+    fields = list(fields)
+    i_fields = cube.labels["field"].get_indexer(fields)
+    if (i_fields < 0).any():
+        raise ValueError(f"Fields not found in the cube: "
+                         f"{[f for f, i in zip(fields, i_fields) if i < 0]}")
+
+    as_of_dates = cube.labels["as_of_date"]
+    week_pos = _get_lag_positions(cube, max_lag)  # (as_of, lag)
+
+    # Training vintages
+    train = np.arange(len(as_of_dates) - 1)  # The latest one is the reference
+    if same_weekday:
+        same = as_of_dates[train].weekday == as_of_dates[-1].weekday()
+        if same.any():
+            train = train[same]
+    if max_train_vintages is not None:
+        train = train[-max_train_vintages:]
+
+    # Reported and final values of each (vintage, lag), shape (as_of, lag, jur, field)
+    # ==================
+    train_week_pos = week_pos[train]
+    valid = train_week_pos >= 0
+    settled = train_week_pos <= (week_pos[-1, 0] - max_lag)  # Old enough in the latest
+
+    # Only the rows of the training weeks are read from the mapped file
+    reported = cube.values[train[:, None], train_week_pos][..., i_fields].astype(float)
+    final = cube.values[-1][train_week_pos][..., i_fields].astype(float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        multiplier = final / reported
+    multiplier[reported == 0] = np.where(final[reported == 0] == 0, 1., np.nan)
+    multiplier[~(valid & settled)] = np.nan
+
+    # Quantiles over the vintages, per jurisdiction and pooled
+    # ==================
+    q = [(1 - interval) / 2, 0.5, (1 + interval) / 2]
+    num_samples = np.sum(~np.isnan(multiplier), axis=0)  # (lag, jur, field)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # All-NaN slices
+        quantiles = np.nanquantile(multiplier, q, axis=0)  # (q, lag, jur, field)
+        pooled = np.nanquantile(
+            multiplier.transpose(0, 2, 1, 3).reshape(-1, max_lag, len(fields)),
+            q, axis=0)  # (q, lag, field)
+
+    quantiles = np.where(np.isnan(quantiles), pooled[:, :, None, :], quantiles)
+    quantiles = np.where(np.isnan(quantiles), 1., quantiles)  # No data at all
+
+    # Long format, in (field, jurisdiction, lag) order
+    index = pd.MultiIndex.from_product(
+        [fields, cube.labels["jurisdiction"], np.arange(max_lag)],
+        names=["field", "jurisdiction", "lag"])
+    quantiles = quantiles.transpose(0, 3, 2, 1).reshape(len(q), -1)
+    return pd.DataFrame({
+        "lower": quantiles[0],
+        "median": quantiles[1],
+        "upper": quantiles[2],
+        "num_samples": num_samples.transpose(2, 1, 0).ravel(),
+    }, index=index)
+
+
+def apply_completeness(cube: ArchiveCube, multipliers_df: pd.DataFrame) -> pd.DataFrame:
+    """Correct the recent weeks of the latest snapshot of the cube with
+    the multipliers from `estimate_completeness`.
+
+    Returns
+    -------
+    pd.DataFrame
+        Data frame with columns "weekendingdate", "jurisdiction", "field",
+        "lag", "reported" (value in the latest snapshot), "lower",
+        "median" and "upper" (corrected values). Cells not reported in
+        the latest snapshot are dropped.
+    """
+    fields = list(multipliers_df.index.get_level_values("field").unique())
+    max_lag = multipliers_df.index.get_level_values("lag").max() + 1
+    i_fields = cube.labels["field"].get_indexer(fields)
+
+    week_pos = _get_lag_positions(cube, max_lag)[-1]
+    week_pos = week_pos[week_pos >= 0]
+    reported = cube.values[-1][week_pos][:, :, i_fields].astype(float)  # (lag, jur, field)
+
+    # Long format, matching the order of the multipliers
+    index = pd.MultiIndex.from_product(
+        [fields, cube.labels["jurisdiction"], np.arange(len(week_pos))],
+        names=["field", "jurisdiction", "lag"])
+    df = pd.DataFrame(
+        {"reported": reported.transpose(2, 1, 0).ravel()}, index=index)
+    df = df.join(multipliers_df[["lower", "median", "upper"]], how="left")
+    for col in ["lower", "median", "upper"]:
+        df[col] = df["reported"] * df[col]
+
+    df = df.dropna(subset=["reported"]).reset_index()
+    df.insert(0, "weekendingdate", cube.labels["weekendingdate"][week_pos][df["lag"]])
+    return df[["weekendingdate", "jurisdiction", "field", "lag",
+               "reported", "lower", "median", "upper"]]
+
+
+def open_updated_cube(dataset_dir: Union[str, Path] = _ARCHIVE_DIR) -> ArchiveCube:
+    """Open the cube of the archive, (re)building it if it is missing
+    or older than the latest snapshot in the catalog.
+    """
+    catalog_df = load_archive_catalog(dataset_dir)
+    latest_as_of = catalog_df.loc[catalog_df["exists"], "as_of_date"].max()
+    try:
+        cube = open_archive_cube(dataset_dir)
+        if cube.labels["as_of_date"][-1] >= latest_as_of and all(
+                field in cube.labels["field"] for field in _NOWCAST_FIELDS):
+            return cube
+    except (FileNotFoundError, ValueError):  # Missing or inconsistent
+        pass
+
+    build_archive_cube(dataset_dir)
+    return open_archive_cube(dataset_dir)
+
+
+def nowcast_latest(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        **kwargs,
+) -> pd.DataFrame:
+    """Nowcast of the latest snapshot of the archive. Keyword arguments
+    are passed to `estimate_completeness`. See `apply_completeness` for
+    the output format.
+    """
+    cube = open_updated_cube(dataset_dir)
+    multipliers_df = estimate_completeness(cube, **kwargs)
+    return apply_completeness(cube, multipliers_df)
+
+
+# ==========================================================
+
+
+if __name__ == "__main__":
+
+    def parse_args():
+        parser = argparse.ArgumentParser(
+            usage="Correct the recent weeks of the latest NHSN snapshot "
+                  "from the revision history of the archive.",
+        )
+        parser.add_argument(
+            "--dataset-dir",
+            type=Path,
+            help="Directory of the archive.",
+            default=_ARCHIVE_DIR,
+        )
+
+        parser.add_argument(
+            "--max-lag",
+            type=int,
+            help="Number of recent weeks to correct.",
+            default=8,
+        )
+
+        parser.add_argument(
+            "--interval",
+            type=float,
+            help="Probability mass of the uncertainty band.",
+            default=0.9,
+        )
+
+        parser.add_argument(
+            "--output", "-o",
+            type=Path,
+            help="File to export the nowcast on (CSV).",
+            default=None,
+        )
+
+        return parser.parse_args()
+
+
+    def main():
+        args = parse_args()
+        nowcast_df = nowcast_latest(
+            args.dataset_dir, max_lag=args.max_lag, interval=args.interval)
+
+        print(nowcast_df.loc[nowcast_df["jurisdiction"] == "USA"].to_string(index=False))
+
+        if args.output is not None:
+            print(f"Exporting to {args.output}...")
+            args.output.parent.mkdir(parents=True, exist_ok=True)
+            nowcast_df.to_csv(args.output, index=False, float_format="%.8g")
+            print("Exporting done.")
+
+    main()
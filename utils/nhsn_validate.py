@@ -0,0 +1,450 @@
+"""
+Integrity and schema checks of the archive of NHSN snapshots.
+
+Each archived file is checked against its entry in the catalog
+(`metadata.yaml`) and against the previous vintage:
+- The file can be parsed and has the index columns.
+- Content hash and row count match the catalog (entries written since
+  these fields were introduced have `sha256` and `num_rows`).
+- Row count below the API entry limit (otherwise the fetch was probably
+  truncated).
+- Column set compared to `_INTEREST_NHSN_FIELDS`.
+- No duplicate (weekendingdate, jurisdiction) keys.
+- Weeks end on Saturdays, are contiguous and do not go past the as-of date.
+- No negative counts.
+- No implausible revisions of the total admissions from the previous
+  vintage (large relative and absolute changes).
+Then, across the archive: catalog entries without files and the
+reverse, and vintages whose coverage (last week, jurisdictions) shrinks
+from the previous vintage of the same release.
+
+Files are checked in parallel processes. Results are cached in the
+archive directory (`.validation_cache.json`, not versioned) and reused
+for files whose content (SHA-256), catalog entry and previous vintage
+did not change, so a new snapshot only costs its own checks (plus
+hashing the files, which is much faster than parsing them). The cache
+does not depend on file times, so it stays valid in a fresh checkout:
+the workflows restore it from the GitHub Actions cache.
+
+The report is a JSON document with the results of each file. The command
+exits with status 1 if any error is found, so it can gate a commit:
+```bash
+python -m utils.nhsn_validate --output validation_report.json
+```
+"""
+import argparse
+import hashlib
+import io
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Union
+
+import pandas as pd
+
+from utils.nhsn_data import (
+    _ARCHIVE_DIR, _ARCHIVE_INDEX_FIELDS, _INTEREST_NHSN_FIELDS, _NHSN_ENTRY_LIMIT,
+    load_archive_catalog,
+)
+from utils.nhsn_diff import diff_snapshots
+
+
+_CACHE_FNAME = ".validation_cache.json"
+_LATEST_FNAME = "nhsn_latest.csv"
+_VALIDATOR_VERSION = 1  # Increase to invalidate the cached results
+
+_REVISION_FIELDS = [field for field in _INTEREST_NHSN_FIELDS if field.startswith("totalconf")]
+
+
+def file_sha256(fpath: Union[str, Path]) -> str:
+    """SHA-256 of the contents of a file."""
+    with open(fpath, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def _issue(level, check, message):
+    return dict(level=level, check=check, message=message)
+
+
+def _read_for_validation(content: bytes) -> pd.DataFrame:
+    df = pd.read_csv(io.BytesIO(content))
+    return df.loc[:, ~df.columns.str.startswith("Unnamed")]  # Old index column
+
+
+def _to_snapshot(df: pd.DataFrame) -> pd.DataFrame:
+    """Indexed snapshot with the numeric fields used in the revision check."""
+    df = df.drop_duplicates(subset=_ARCHIVE_INDEX_FIELDS).copy()
+    df["weekendingdate"] = pd.to_datetime(df["weekendingdate"], format="ISO8601", errors="coerce")
+    df = df.set_index(_ARCHIVE_INDEX_FIELDS).reindex(columns=_REVISION_FIELDS)
+    return df.apply(pd.to_numeric, errors="coerce")
+
+
+def _validate_file(task: dict) -> dict:
+    """Check one archived file. Runs in the worker processes.
+
+    The task has the file path, its catalog entry and as-of date, the
+    path of the previous vintage (or None) and the check thresholds.
+    """
+    fpath = Path(task["fpath"])
+    entry = task["entry"]
+    issues = list()
+    result = dict(filename=fpath.name, as_of_date=task["as_of_date"],
+                  release=entry.get("release"), issues=issues)
+
+    with open(fpath, "rb") as fp:
+        content = fp.read()
+    result["sha256"] = hashlib.sha256(content).hexdigest()
+    result["size"] = len(content)
+
+    # Parsing and schema
+    # ==================
+    try:
+        df = _read_for_validation(content)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as err:
+        issues.append(_issue("error", "parse", f"Could not parse the file ({err.__class__.__name__})."))
+        return result
+
+    num_rows = len(df)
+    result["num_rows"] = num_rows
+
+    missing_index = [col for col in _ARCHIVE_INDEX_FIELDS if col not in df.columns]
+    if missing_index:
+        issues.append(_issue("error", "columns", f"Missing index columns: {missing_index}."))
+        return result
+
+    missing_fields = [col for col in _INTEREST_NHSN_FIELDS if col not in df.columns]
+    extra_fields = [col for col in df.columns
+                    if col not in _INTEREST_NHSN_FIELDS + _ARCHIVE_INDEX_FIELDS]
+    if missing_fields:
+        issues.append(_issue("warning", "columns", f"Missing fields: {missing_fields}."))
+    if extra_fields:
+        issues.append(_issue("warning", "columns", f"Unexpected columns: {extra_fields}."))
+
+    # Catalog
+    # ==================
+    if entry.get("sha256") is not None and entry["sha256"] != result["sha256"]:
+        issues.append(_issue("error", "hash", "Content hash differs from the catalog."))
+    if entry.get("num_rows") is not None and entry["num_rows"] != num_rows:
+        issues.append(_issue(
+            "error", "row_count",
+            f"{num_rows} rows, but the catalog has {entry['num_rows']}."))
+    if num_rows >= task["entry_limit"]:
+        issues.append(_issue(
+            "error", "truncation",
+            f"{num_rows} rows, the entry limit of the API request. The data "
+            f"was probably truncated."))
+
+    # Keys and date coverage
+    # ==================
+    num_duplicates = int(df.duplicated(subset=_ARCHIVE_INDEX_FIELDS).sum())
+    if num_duplicates > 0:
+        issues.append(_issue(
+            "error", "duplicate_keys",
+            f"{num_duplicates} duplicate (weekendingdate, jurisdiction) keys."))
+
+    weeks = pd.to_datetime(df["weekendingdate"], format="ISO8601", errors="coerce")
+    if weeks.isna().any():
+        issues.append(_issue(
+            "error", "dates", f"{int(weeks.isna().sum())} unparsable week ending dates."))
+    unique_weeks = pd.DatetimeIndex(weeks.dropna().unique()).sort_values()
+    if len(unique_weeks) > 0:
+        result["first_week"] = unique_weeks[0].date().isoformat()
+        result["last_week"] = unique_weeks[-1].date().isoformat()
+        result["num_jurisdictions"] = int(df["jurisdiction"].nunique())
+
+        not_saturday = unique_weeks[unique_weeks.weekday != 5]
+        if len(not_saturday) > 0:
+            issues.append(_issue(
+                "warning", "dates",
+                f"{len(not_saturday)} week ending dates are not Saturdays."))
+
+        gaps = unique_weeks[1:][(unique_weeks[1:] - unique_weeks[:-1]) != pd.Timedelta(weeks=1)]
+        if len(gaps) > 0:
+            issues.append(_issue(
+                "warning", "dates",
+                f"Weeks are not contiguous, gaps before: "
+                f"{[d.date().isoformat() for d in gaps[:5]]}."))
+
+        if unique_weeks[-1] > pd.Timestamp(task["as_of_date"]):
+            issues.append(_issue(
+                "error", "dates",
+                f"Last week ({result['last_week']}) is after the as-of date."))
+
+    # Values and revisions
+    # ==================
+    snapshot_df = _to_snapshot(df)
+    num_negative = int((snapshot_df < 0).sum().sum())
+    if num_negative > 0:
+        issues.append(_issue("error", "values", f"{num_negative} negative counts."))
+
+    if task["prev_fpath"] is not None:
+        try:
+            with open(task["prev_fpath"], "rb") as fp:
+                prev_df = _to_snapshot(_read_for_validation(fp.read()))
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, KeyError):
+            prev_df = None  # Reported in the check of that file
+
+        if prev_df is not None:
+            change_df = diff_snapshots(prev_df, snapshot_df, fields=_REVISION_FIELDS)
+            change_df = change_df.loc[change_df["change"] == "revised"]
+            abs_change = (change_df["new_value"] - change_df["old_value"]).abs()
+            implausible = change_df.loc[
+                (abs_change > task["revision_abs_threshold"])
+                & (abs_change > task["revision_rel_threshold"] * change_df["old_value"].abs())
+            ]
+            result["num_revised_cells"] = len(change_df)
+            if len(implausible) > 0:
+                examples = [
+                    f"{row.jurisdiction} {row.weekendingdate.date().isoformat()} "
+                    f"{row.field}: {row.old_value:g} -> {row.new_value:g}"
+                    for row in implausible.head(5).itertuples()
+                ]
+                issues.append(_issue(
+                    "warning", "revisions",
+                    f"{len(implausible)} implausible revisions from "
+                    f"{Path(task['prev_fpath']).name}, e.g. {examples}."))
+
+    return result
+
+
+def validate_archive(
+        dataset_dir: Union[str, Path] = _ARCHIVE_DIR,
+        max_workers=None,
+        use_cache=True,
+        entry_limit=_NHSN_ENTRY_LIMIT,
+        revision_rel_threshold=1.,
+        revision_abs_threshold=100.,
+) -> dict:
+    """Check all the files of the archive. See the module docstring.
+
+    Parameters
+    ----------
+    dataset_dir : Union[str, Path]
+        Directory of the archive.
+    max_workers : int, optional
+        Number of worker processes.
+    use_cache : bool
+        Whether to reuse (and update) the cached results.
+    entry_limit : int
+        Entry limit of the API requests. Files with this number of rows
+        are reported as truncated.
+    revision_rel_threshold, revision_abs_threshold : float
+        A revision is implausible if the absolute change is larger than
+        both `revision_abs_threshold` and `revision_rel_threshold` times
+        the previous value.
+
+    Returns
+    -------
+    dict
+        The report, with the results of each file ("files"), the issues
+        of the archive as a whole ("archive_issues") and the counts of
+        errors and warnings.
+    """
+    dataset_dir = Path(dataset_dir)
+    cache_fpath = dataset_dir / _CACHE_FNAME
+    config = dict(
+        version=_VALIDATOR_VERSION,
+        entry_limit=entry_limit,
+        revision_rel_threshold=revision_rel_threshold,
+        revision_abs_threshold=revision_abs_threshold,
+    )
+
+    catalog_df = load_archive_catalog(dataset_dir)
+    archive_issues = list()
+
+    # Catalog vs directory
+    # ==================
+    for fname in catalog_df.loc[~catalog_df["exists"], "filename"]:
+        archive_issues.append(dict(
+            _issue("error", "catalog", "Catalog entry without a file."), filename=fname))
+    for fname in catalog_df.loc[catalog_df["filename"].duplicated(), "filename"].unique():
+        archive_issues.append(dict(
+            _issue("warning", "catalog", "File listed more than once in the catalog."),
+            filename=fname))
+
+    cataloged = set(catalog_df["filename"])
+    for fpath in sorted(dataset_dir.glob("nhsn_*.csv")):
+        if fpath.name != _LATEST_FNAME and fpath.name not in cataloged:
+            archive_issues.append(dict(
+                _issue("warning", "catalog", "File not listed in the catalog."),
+                filename=fpath.name))
+
+    # Tasks, in as-of date order, each with the previous vintage
+    # ==================
+    files_df = catalog_df.loc[catalog_df["exists"]].drop_duplicates(subset="filename")
+    files_df = files_df.sort_values("as_of_date", kind="stable")
+    entries = [
+        {key: value for key, value in entry.items() if not pd.isna(value)}
+        for entry in files_df.drop(columns=["as_of_date", "exists"]).to_dict("records")
+    ]
+
+    cache = dict()
+    if use_cache and cache_fpath.is_file():
+        with open(cache_fpath, "r") as fp:
+            cache = json.load(fp)
+
+    # Cache keys, from the contents of the file and the previous vintage
+    sha_list = [file_sha256(dataset_dir / entry["filename"]) for entry in entries]
+
+    tasks, keys = list(), list()
+    prev_fpath, prev_sha = None, None
+    for entry, as_of_date, sha in zip(entries, files_df["as_of_date"], sha_list):
+        fpath = dataset_dir / entry["filename"]
+        tasks.append(dict(
+            config,
+            fpath=str(fpath),
+            entry=entry,
+            as_of_date=as_of_date.date().isoformat(),
+            prev_fpath=str(prev_fpath) if prev_fpath is not None else None,
+        ))
+        keys.append(json.dumps([
+            sha, prev_sha, tasks[-1]["prev_fpath"], entry, config,
+        ], sort_keys=True, default=str))
+        prev_fpath, prev_sha = fpath, sha
+
+    # Check the files that are not in the cache, in parallel
+    # ==================
+    results = [None] * len(tasks)
+    to_run = list()
+    for i, (task, key) in enumerate(zip(tasks, keys)):
+        cached = cache.get(Path(task["fpath"]).name)
+        if cached is not None and cached["key"] == key:
+            results[i] = cached["result"]
+        else:
+            to_run.append(i)
+
+    print(f"Validating {len(to_run)} files ({len(tasks) - len(to_run)} cached)...")
+    if len(to_run) > 0:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for i, result in zip(to_run, executor.map(_validate_file, [tasks[i] for i in to_run])):
+                results[i] = result
+
+    if use_cache:
+        cache = {
+            Path(task["fpath"]).name: dict(key=key, result=result)
+            for task, key, result in zip(tasks, keys, results)
+        }
+        with open(cache_fpath, "w") as fp:
+            json.dump(cache, fp)
+
+    # Coverage across vintages of the same release
+    # ==================
+    # (the preliminary releases do not have the NHSN region rows)
+    prev_by_release = dict()
+    for result in results:
+        prev = prev_by_release.get(result["release"])
+        if prev is not None and "last_week" in result:
+            if result["last_week"] < prev["last_week"]:
+                archive_issues.append(dict(_issue(
+                    "warning", "coverage",
+                    f"Last week ({result['last_week']}) is earlier than in the "
+                    f"previous vintage ({prev['last_week']})."), filename=result["filename"]))
+            if result["num_jurisdictions"] < prev["num_jurisdictions"]:
+                archive_issues.append(dict(_issue(
+                    "warning", "coverage",
+                    f"{result['num_jurisdictions']} jurisdictions, fewer than in the "
+                    f"previous vintage ({prev['num_jurisdictions']})."), filename=result["filename"]))
+        if "last_week" in result:
+            prev_by_release[result["release"]] = result
+
+    latest_fpath = dataset_dir / _LATEST_FNAME
+    if latest_fpath.exists() and len(results) > 0:
+        latest_sha = file_sha256(latest_fpath)
+        if latest_sha not in {result["sha256"] for result in results}:
+            archive_issues.append(dict(_issue(
+                "warning", "latest", "Not equal to any archived vintage."),
+                filename=_LATEST_FNAME))
+
+    all_issues = archive_issues + [issue for result in results for issue in result["issues"]]
+    return dict(
+        generated_at=datetime.now(tz=timezone.utc).isoformat(),
+        dataset_dir=str(dataset_dir),
+        config=config,
+        num_files=len(results),
+        num_errors=sum(issue["level"] == "error" for issue in all_issues),
+        num_warnings=sum(issue["level"] == "warning" for issue in all_issues),
+        archive_issues=archive_issues,
+        files=results,
+    )
+
+
+def print_report_summary(report: dict):
+    """Print the issues of a validation report."""
+    for issue in report["archive_issues"]:
+        print(f"[{issue['level']}] {issue['filename']}: ({issue['check']}) {issue['message']}")
+    for result in report["files"]:
+        for issue in result["issues"]:
+            print(f"[{issue['level']}] {result['filename']}: ({issue['check']}) {issue['message']}")
+    print(f"{report['num_files']} files checked: {report['num_errors']} errors, "
+          f"{report['num_warnings']} warnings.")
+
+
+# ==========================================================
+
+
+if __name__ == "__main__":
+
+    def parse_args():
+        parser = argparse.ArgumentParser(
+            usage="Check the integrity of the archive of NHSN snapshots.",
+        )
+        parser.add_argument(
+            "--dataset-dir",
+            type=Path,
+            help="Directory of the archive.",
+            default=_ARCHIVE_DIR,
+        )
+
+        parser.add_argument(
+            "--output", "-o",
+            type=Path,
+            help="File to export the report on (JSON).",
+            default=None,
+        )
+
+        parser.add_argument(
+            "--max-workers",
+            type=int,
+            help="Number of worker processes.",
+            default=None,
+        )
+
+        parser.add_argument(
+            "--cache",
+            action=argparse.BooleanOptionalAction,
+            help="Whether to reuse the results of unchanged files.",
+            default=True,
+        )
+
+        parser.add_argument(
+            "--quiet", "-q",
+            action="store_true",
+            help="Only print the counts of errors and warnings.",
+        )
+
+        return parser.parse_args()
+
+
+    def main():
+        args = parse_args()
+        report = validate_archive(
+            args.dataset_dir, max_workers=args.max_workers, use_cache=args.cache)
+
+        if args.quiet:
+            print(f"{report['num_files']} files checked: {report['num_errors']} errors, "
+                  f"{report['num_warnings']} warnings.")
+        else:
+            print_report_summary(report)
+
+        if args.output is not None:
+            print(f"Exporting to {args.output}...")
+            args.output.parent.mkdir(parents=True, exist_ok=True)
+            with open(args.output, "w") as fp:
+                json.dump(report, fp, indent=1)
+            print("Exporting done.")
+
+        sys.exit(1 if report["num_errors"] > 0 else 0)
+
+    main()
@@ -0,0 +1,274 @@
+"""
+Release-aware polling of the NHSN datasets.
+
+NHSN publishes the preliminary data on Wednesdays and the consolidated
+data on Fridays, usually between the morning and early afternoon
+(US/Eastern). The `ReleaseScheduler` polls only the metadata endpoints
+of the datasets, which are cheap, and triggers a pipeline (fetch, export
+and report) as soon as the `updatedAt` field of a dataset changes.
+
+The polling interval adapts to the expected releases:
+- Inside a release window, the metadata is polled every `min_interval`
+  seconds, until that release is captured.
+- Outside the windows (or after the release of the window was captured),
+  the interval doubles at each unchanged poll, up to `max_interval`, but
+  never sleeps past the start of the next window.
+
+Every capture is recorded with its latency (time between `updatedAt` and
+the detection of the change) and the duration of the pipeline.
+
+The clock, the sleep function and the metadata URLs are parameters, so
+that the scheduler can be run against a local stand-in server with a fake
+clock. For example:
+```python
+clock = FakeClock(start=...)  # Any object with `time()` and `sleep(seconds)`
+scheduler = ReleaseScheduler(
+    fetch_updated_at=lambda release: fetch_release_updated_at(
+        release, metadata_url_fmt="http://localhost:8001/{uuid}"),
+    run_pipeline=lambda release: print("Triggered", release),
+    clock=clock.time, sleep=clock.sleep,
+)
+scheduler.run(max_polls=100)
+```
+"""
+import csv
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import requests
+
+from utils.nhsn_metadata import (
+    _NHSN_METADATA_REQUEST_FMT, _UUID_CONSOLIDATED, _UUID_PRELIMINARY,
+    parse_updated_at,
+)
+
+
+_RELEASE_TZ = ZoneInfo("America/New_York")
+
+# --- Expected release windows: release -> (weekday, start hour, end hour), US/Eastern
+# Weekdays as in `datetime.weekday()`: Monday is 0.
+_RELEASE_WINDOWS = {
+    "prelim": (2, 8, 17),  # Wednesday
+    "consol": (4, 8, 17),  # Friday
+}
+
+_RELEASE_UUIDS = {
+    "prelim": _UUID_PRELIMINARY,
+    "consol": _UUID_CONSOLIDATED,
+}
+
+_METRICS_FIELDS = [
+    "release", "updated_at", "detected_at", "capture_latency_s",
+    "pipeline_duration_s", "pipeline_ok", "num_polls",
+]
+
+
+def fetch_release_updated_at(release, metadata_url_fmt=_NHSN_METADATA_REQUEST_FMT,
+                             timeout=30) -> datetime:
+    """Request the metadata of one release ("prelim" or "consol") and
+    return its `updatedAt` field.
+    """
+    url = metadata_url_fmt.format(uuid=_RELEASE_UUIDS[release])
+    response = requests.get(url, timeout=timeout)
+    response.raise_for_status()
+    return parse_updated_at(response.json()["updatedAt"])
+
+
+def run_pipeline_scripts(release, make_report=True) -> bool:
+    """Run the fetch/export script for a release and, optionally, the
+    report builder, as subprocesses. Returns whether all steps succeeded.
+    """
+    commands = [[
+        sys.executable, "get_nhsn_snapshot.py",
+        "--release", release, "--fetch-trigger", "scheduler",
+    ]]
+    if make_report:
+        commands.append([sys.executable, "generate_simple_report.py"])
+
+    for command in commands:
+        print(f"Running: {' '.join(command)}")
+        if subprocess.run(command).returncode != 0:
+            print(f"Warning: command failed: {' '.join(command)}")
+            return False
+    return True
+
+
+class ReleaseScheduler:
+    """Polls the `updatedAt` of each release and runs the pipeline when it
+    changes. See the module docstring.
+
+    Parameters
+    ----------
+    fetch_updated_at : callable
+        Called with a release ("prelim" or "consol"), returns its current
+        `updatedAt` as an aware datetime.
+    run_pipeline : callable
+        Called with the release that changed. Returns whether the
+        pipeline succeeded.
+    last_updated_at : dict, optional
+        Last known `updatedAt` of each release (e.g. from the catalog,
+        see `utils.nhsn_metadata.get_catalog_updated_at`). Releases
+        without a known value are captured at the first poll.
+    clock : callable
+        Returns the current time as seconds since the epoch.
+    sleep : callable
+        Sleeps for the given number of seconds.
+    min_interval, max_interval : float
+        Polling intervals inside a release window and the maximum one
+        outside the windows, in seconds.
+    metrics_path : Union[str, Path], optional
+        CSV file to append the capture metrics to.
+    """
+
+    def __init__(
+            self,
+            fetch_updated_at,
+            run_pipeline,
+            last_updated_at=None,
+            clock=time.time,
+            sleep=time.sleep,
+            min_interval=120.,
+            max_interval=3600.,
+            metrics_path=None,
+            release_windows=None,
+    ):
+        self.fetch_updated_at = fetch_updated_at
+        self.run_pipeline = run_pipeline
+        self.last_updated_at = dict(last_updated_at or dict())
+        self.clock = clock
+        self.sleep = sleep
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.metrics_path = Path(metrics_path) if metrics_path is not None else None
+        self.release_windows = release_windows or _RELEASE_WINDOWS
+
+        self.num_polls = 0
+        self.metrics = list()     # One dict per capture
+        self._idle_interval = min_interval  # Grows while nothing changes
+
+    # --- Release windows
+    # ------------------
+
+    def _now(self) -> datetime:
+        return datetime.fromtimestamp(self.clock(), tz=_RELEASE_TZ)
+
+    def _window_bounds(self, release, day: date):
+        weekday, start_hour, end_hour = self.release_windows[release]
+        start = datetime(day.year, day.month, day.day, start_hour, tzinfo=_RELEASE_TZ)
+        end = datetime(day.year, day.month, day.day, end_hour, tzinfo=_RELEASE_TZ)
+        return start, end
+
+    def open_windows(self, now: datetime) -> list:
+        """Releases whose window is open now and not yet captured."""
+        result = list()
+        for release, (weekday, _, _) in self.release_windows.items():
+            if now.weekday() != weekday:
+                continue
+            start, end = self._window_bounds(release, now.date())
+            # Releases published on the window day before it opens count as well
+            last = self.last_updated_at.get(release)
+            captured = last is not None and last.astimezone(_RELEASE_TZ).date() >= now.date()
+            if start <= now < end and not captured:
+                result.append(release)
+        return result
+
+    def seconds_to_next_window(self, now: datetime) -> float:
+        """Seconds until the start of the next release window."""
+        best = None
+        for release, (weekday, _, _) in self.release_windows.items():
+            days_ahead = (weekday - now.weekday()) % 7
+            start, _ = self._window_bounds(release, now.date() + timedelta(days=days_ahead))
+            if start <= now:
+                start += timedelta(weeks=1)
+            delta = (start - now).total_seconds()
+            best = delta if best is None else min(best, delta)
+        return best
+
+    def next_interval(self, changed=False) -> float:
+        """Seconds to wait before the next poll."""
+        now = self._now()
+        if self.open_windows(now):
+            self._idle_interval = self.min_interval
+            return self.min_interval
+
+        if changed:
+            self._idle_interval = self.min_interval
+        else:
+            self._idle_interval = min(2 * self._idle_interval, self.max_interval)
+
+        # Wake up at the start of the next window
+        return max(min(self._idle_interval, self.seconds_to_next_window(now)), 1.)
+
+    # --- Polling
+    # ------------------
+
+    def poll_once(self) -> list:
+        """Check each release once and run the pipeline for the ones that
+        changed. Returns the list of releases that changed.
+        """
+        self.num_polls += 1
+        changed = list()
+        for release in self.release_windows:
+            try:
+                updated_at = self.fetch_updated_at(release)
+            except requests.exceptions.RequestException as err:
+                print(f"Warning: metadata request for `{release}` failed: {err}")
+                continue
+
+            last = self.last_updated_at.get(release)
+            if last is None or updated_at > last:
+                changed.append((updated_at, release))
+
+        # If both changed, the most recent update is fetched last, so that
+        # it ends up as the `latest` file
+        for updated_at, release in sorted(changed):
+            self._capture(release, updated_at)
+
+        return [release for _, release in sorted(changed)]
+
+    def _capture(self, release, updated_at: datetime):
+        detected_at = self.clock()
+        print(f"New `{release}` release detected (updatedAt = {updated_at.isoformat()}).")
+
+        ok = self.run_pipeline(release)
+        pipeline_duration = self.clock() - detected_at
+
+        # Only mark as captured if the pipeline worked, so that it's retried
+        if ok:
+            self.last_updated_at[release] = updated_at
+
+        self._record_metrics(dict(
+            release=release,
+            updated_at=updated_at.isoformat(),
+            detected_at=datetime.fromtimestamp(detected_at, tz=timezone.utc).isoformat(),
+            capture_latency_s=round(detected_at - updated_at.timestamp(), 3),
+            pipeline_duration_s=round(pipeline_duration, 3),
+            pipeline_ok=bool(ok),
+            num_polls=self.num_polls,
+        ))
+
+    def _record_metrics(self, record: dict):
+        self.metrics.append(record)
+        print(f"Capture metrics: {record}")
+        if self.metrics_path is None:
+            return
+
+        write_header = not self.metrics_path.exists()
+        self.metrics_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.metrics_path, "a", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=_METRICS_FIELDS)
+            if write_header:
+                writer.writeheader()
+            writer.writerow(record)
+
+    def run(self, max_polls=None):
+        """Poll until interrupted, or for `max_polls` polls."""
+        while max_polls is None or self.num_polls < max_polls:
+            changed = self.poll_once()
+            interval = self.next_interval(changed=bool(changed))
+            print(f"Next poll in {interval:.0f} s")
+            self.sleep(interval)
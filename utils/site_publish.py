@@ -0,0 +1,136 @@
+"""
+Incremental publishing of the static site (`pages/` build directory).
+
+The site is rendered into a staging directory next to the build
+directory, and then swapped in place of it. A failed build leaves the
+previous site untouched.
+
+A manifest (`manifest.json`) with the SHA-256 of each published file is
+kept in the build directory. Files whose hash did not change since the
+last build are hard linked from the previous build instead of written
+again, and the manifests of two builds tell which files a redeploy has
+to upload (`diff_manifests`).
+
+Data payloads can be given content-addressed names (`hashed_path`), so
+that a file name always refers to the same contents and unchanged data
+keeps its name across builds.
+"""
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Union
+
+
+_MANIFEST_FNAME = "manifest.json"
+_HASH_LENGTH = 12  # Hex digits of the content hash in file names
+
+
+def _to_bytes(content: Union[str, bytes]) -> bytes:
+    return content.encode() if isinstance(content, str) else content
+
+
+def hashed_path(relpath: str, content: Union[str, bytes]) -> str:
+    """Insert the content hash into a file path, before the extension:
+    "data/flu/CA.json" -> "data/flu/CA.<hash>.json".
+    """
+    digest = hashlib.sha256(_to_bytes(content)).hexdigest()[:_HASH_LENGTH]
+    stem, dot, suffix = relpath.rpartition(".")
+    if not dot or "/" in suffix:
+        return f"{relpath}.{digest}"
+    return f"{stem}.{digest}.{suffix}"
+
+
+def load_manifest(build_dir: Union[str, Path], manifest_fname=_MANIFEST_FNAME) -> dict:
+    """Manifest of a build directory ({relative path: sha256}). Empty if
+    the directory was not built by `publish_site`.
+    """
+    fpath = Path(build_dir) / manifest_fname
+    if not fpath.is_file():
+        return dict()
+    with open(fpath, "r") as fp:
+        return json.load(fp)
+
+
+def diff_manifests(old_manifest: dict, new_manifest: dict) -> dict:
+    """Files added, changed and removed from one build to another."""
+    return dict(
+        added=sorted(set(new_manifest) - set(old_manifest)),
+        changed=sorted(path for path in set(new_manifest) & set(old_manifest)
+                       if new_manifest[path] != old_manifest[path]),
+        removed=sorted(set(old_manifest) - set(new_manifest)),
+    )
+
+
+def publish_site(
+        files: dict,
+        build_dir: Union[str, Path],
+        manifest_fname=_MANIFEST_FNAME,
+) -> dict:
+    """Publish the files of the site into the build directory.
+
+    Parameters
+    ----------
+    files : dict
+        Contents (str or bytes) of each file, keyed by its path relative
+        to the build directory. Files of the previous build that are not
+        in this dictionary are removed.
+    build_dir : Union[str, Path]
+        The build directory.
+    manifest_fname : str
+        Name of the manifest file, written in the build directory.
+
+    Returns
+    -------
+    dict
+        The changes from the previous build ("added", "changed" and
+        "removed" lists of paths, see `diff_manifests`) and the number of
+        files reused from it ("num_unchanged").
+    """
+    build_dir = Path(build_dir)
+    staging_dir = build_dir.with_name(f".{build_dir.name}.staging")
+    old_dir = build_dir.with_name(f".{build_dir.name}.old")
+
+    # Leftovers of an interrupted build
+    for dirpath in [staging_dir, old_dir]:
+        if dirpath.exists():
+            shutil.rmtree(dirpath)
+
+    old_manifest = load_manifest(build_dir, manifest_fname)
+    new_manifest = dict()
+
+    # Render into the staging directory
+    # ==================
+    num_unchanged = 0
+    for relpath, content in files.items():
+        content = _to_bytes(content)
+        digest = hashlib.sha256(content).hexdigest()
+        new_manifest[relpath] = digest
+
+        dst = staging_dir / relpath
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        src = build_dir / relpath
+        if old_manifest.get(relpath) == digest and src.is_file():
+            try:
+                os.link(src, dst)
+            except OSError:  # E.g. file system without hard links
+                shutil.copy2(src, dst)
+            num_unchanged += 1
+        else:
+            dst.write_bytes(content)
+
+    with open(staging_dir / manifest_fname, "w") as fp:
+        json.dump(new_manifest, fp, indent=0, sort_keys=True)
+
+    # Swap the staging directory in place of the build directory
+    # ==================
+    # Two renames: the build directory is only missing between them
+    if build_dir.exists():
+        os.rename(build_dir, old_dir)
+    os.rename(staging_dir, build_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    result = diff_manifests(old_manifest, new_manifest)
+    result["num_unchanged"] = num_unchanged
+    return result
@@ -0,0 +1,377 @@
+"""
+Fetch and archive datasets from the CDC SODA API (data.cdc.gov), as
+described in the dataset registry (`utils/dataset_registry.py`).
+
+Datasets are fetched in pages (`$limit`/`$offset`, ordered with `$order`)
+and each page is appended to the output CSV file as soon as it arrives,
+so the whole dataset is never held in memory. The columns of the file are
+fixed before the first page: the requested fields, or all the columns of
+the dataset (from its view metadata) if no fields are given. Records with
+other fields fail the fetch instead of losing them.
+Each dataset has at most `max_concurrency` page requests in flight, which
+bounds both the load on the API and the memory used (`page_size` times
+`max_concurrency` rows). Several datasets are processed concurrently.
+
+For each dataset, the `updatedAt` field of its metadata is compared with
+the catalog (`metadata.yaml` in the output directory), and the data is
+only fetched if it is newer. The new file is written under a temporary
+name and renamed when complete, then added to the catalog. Finally, the
+post-archive hooks of the dataset (`utils/archive_hooks.py`) compute its
+derived outputs, e.g. the aggregates and cube of the NHSN data.
+
+Both `archive_datasets.py` and `get_nhsn_snapshot.py` archive through
+`archive_dataset`. This module does not import pandas.
+"""
+import csv
+import hashlib
+import os
+import shutil
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import requests
+
+from utils.archive_hooks import run_post_archive_hooks
+from utils.nhsn_metadata import parse_updated_at
+from utils.yaml_tools import load_yaml, save_yaml
+
+
+_METADATA_FNAME = "metadata.yaml"
+_REQUEST_RETRIES = 3
+
+# Catalogs shared by several datasets (e.g. both NHSN releases) are
+# updated by one thread at a time
+_CATALOG_LOCKS = dict()
+_CATALOG_LOCKS_GUARD = threading.Lock()
+
+
+def _get_catalog_lock(output_dir: Path) -> threading.Lock:
+    with _CATALOG_LOCKS_GUARD:
+        return _CATALOG_LOCKS.setdefault(output_dir.resolve(), threading.Lock())
+
+
+# --- Requests
+# ------------------
+
+
+def _request_json(url, params=None, timeout=60.):
+    """GET request with a few retries on connection errors, server errors
+    and throttling (HTTP 429), with exponential backoff. Returns the
+    decoded JSON.
+    """
+    for attempt in range(_REQUEST_RETRIES):
+        wait = 2 ** attempt
+        try:
+            response = requests.get(url, params=params, timeout=timeout)
+            if response.status_code < 500 and response.status_code != 429:
+                response.raise_for_status()
+                return response.json()
+            error = requests.exceptions.HTTPError(
+                f"HTTP {response.status_code}: {response.text[:200]}", response=response)
+            # Throttled requests may say how long to wait
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                wait = max(wait, int(retry_after))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            error = err
+        print(f"Warning: request to {url} failed ({error}). Attempt {attempt + 1} of {_REQUEST_RETRIES}.")
+        if attempt + 1 < _REQUEST_RETRIES:
+            time.sleep(wait)
+    raise error
+
+
+def get_dataset_columns(spec: dict, timeout=60.) -> list:
+    """Names of the columns of a dataset, from its view metadata. System
+    fields (":id", ":updated_at", etc) are not included.
+    """
+    view = _request_json(spec["columns_url_fmt"].format(uuid=spec["uuid"]), timeout=timeout)
+    return [column["fieldName"] for column in view["columns"]
+            if not column["fieldName"].startswith(":")]
+
+
+def get_output_columns(spec: dict, timeout=60.) -> list:
+    """Columns of the archived files of a dataset: the key columns, then
+    the requested fields, or all the other columns of the dataset if
+    `spec["fields"]` is None.
+    """
+    key_columns = list(spec["key_columns"] or [])
+    if spec["fields"] is not None:
+        fields = list(spec["fields"])
+    else:
+        fields = get_dataset_columns(spec, timeout=timeout)
+    return list(dict.fromkeys(key_columns + fields))
+
+
+def iter_soda_pages(spec: dict, columns=None, timeout=60.):
+    """Yield the pages (lists of records) of a dataset, in order.
+
+    Only `columns` are requested (`$select`), if given. Up to
+    `spec["max_concurrency"]` pages are requested at a time. The
+    iteration stops at the first page with fewer rows than the page size.
+    """
+    url = spec["data_url_fmt"].format(uuid=spec["uuid"])
+    page_size = spec["page_size"]
+    order_by = spec["order_by"] or spec["key_columns"]
+    base_params = dict()
+    if columns is not None:
+        base_params["$select"] = ",".join(columns)
+    if order_by:
+        base_params["$order"] = ",".join(order_by)
+    else:
+        base_params["$order"] = ":id"  # Row identifier, for stable paging
+
+    def request_page(offset):
+        return _request_json(
+            url, dict(base_params, **{"$limit": page_size, "$offset": offset}), timeout)
+
+    with ThreadPoolExecutor(max_workers=spec["max_concurrency"]) as executor:
+        pending = deque()
+        next_offset = 0
+        last_page_seen = False
+        while True:
+            # Keep the window of requests full until the last page is seen
+            while not last_page_seen and len(pending) < spec["max_concurrency"]:
+                pending.append(executor.submit(request_page, next_offset))
+                next_offset += page_size
+            if not pending:
+                break
+
+            page = pending.popleft().result()
+            if len(page) < page_size:
+                last_page_seen = True  # Requests already sent return empty pages
+            if len(page) > 0:
+                yield page
+
+
+def fetch_dataset_to_csv(spec: dict, fpath: Path, timeout=60.) -> dict:
+    """Stream a dataset into a CSV file. The file is written under a
+    temporary name and only renamed to `fpath` when complete.
+
+    The columns of the file are given by `get_output_columns`. A record
+    with any other field raises a ValueError, and the file is not
+    written.
+
+    Returns a dictionary with the number of rows and the SHA-256 of the
+    file.
+    """
+    fpath = Path(fpath)
+    tmp_fpath = fpath.with_name(f".{fpath.name}.{spec['uuid']}.part")
+    columns = get_output_columns(spec, timeout=timeout)
+    known_columns = set(columns)
+    sha = hashlib.sha256()
+    num_rows = 0
+
+    class _HashingWriter:
+        """Writes to the file and updates the hash with the same text."""
+
+        def __init__(self, fp):
+            self.fp = fp
+
+        def write(self, text):
+            sha.update(text.encode())
+            return self.fp.write(text)
+
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(tmp_fpath, "w", newline="") as fp:
+            # LF line ends, as in the files written by pandas
+            writer = csv.DictWriter(_HashingWriter(fp), fieldnames=columns, lineterminator="\n")
+            writer.writeheader()
+            for page in iter_soda_pages(spec, columns=columns, timeout=timeout):
+                for record in page:
+                    unknown = record.keys() - known_columns
+                    if unknown:
+                        raise ValueError(
+                            f"[{spec['uuid']}] Records have fields that are not in the "
+                            f"columns of the dataset: {sorted(unknown)}.")
+                    for col in spec["date_columns"]:
+                        if col in record:
+                            record[col] = record[col][:10]
+                writer.writerows(page)
+                num_rows += len(page)
+                print(f"[{spec['uuid']}] {num_rows} rows written...")
+        os.replace(tmp_fpath, fpath)
+    finally:
+        if tmp_fpath.exists():
+            tmp_fpath.unlink()
+
+    return dict(num_rows=num_rows, sha256=sha.hexdigest())
+
+
+# --- Archiving
+# ------------------
+
+
+def _is_dataset_entry(name, spec: dict, entry: dict) -> bool:
+    """Whether a catalog entry is a file of the dataset (of the release,
+    if the dataset has one).
+    """
+    if spec["release"] is not None:
+        return entry.get("release") == spec["release"]
+    return entry.get("dataset") == name
+
+
+def get_last_archived_updated_at(name, spec: dict, dataset_metadata: dict):
+    """Latest `data_updated_at` of a dataset in its catalog, or None."""
+    result = None
+    for entry in dataset_metadata.get("files") or list():
+        if not _is_dataset_entry(name, spec, entry) or entry.get("data_updated_at") is None:
+            continue
+        updated_at = parse_updated_at(entry["data_updated_at"])
+        if result is None or updated_at > result:
+            result = updated_at
+    return result
+
+
+def get_archived_filename(name, spec: dict, dataset_metadata: dict, updated_at: datetime):
+    """File of the catalog with the data of a dataset updated at
+    `updated_at`, or None.
+    """
+    for entry in dataset_metadata.get("files") or list():
+        if (_is_dataset_entry(name, spec, entry)
+                and entry.get("data_updated_at") is not None
+                and parse_updated_at(entry["data_updated_at"]) == updated_at):
+            return entry["filename"]
+    return None
+
+
+def _reserve_filename(name, spec: dict, updated_at: datetime, output_dir: Path,
+                      reserved_fpaths: set, reserve=True, archived_filename=None) -> str:
+    """Name of the archived file: "{file_prefix}_{date}.csv", or with the
+    release (or dataset name) appended if that file is already taken,
+    e.g. by another release updated on the same day.
+
+    If given, `archived_filename` (the file of the same data in the
+    catalog) is used instead, to be overwritten. `reserved_fpaths` holds
+    the files being written by the same run, and the chosen file is added
+    to it if `reserve` is True.
+    """
+    filename = archived_filename or f"{spec['file_prefix']}_{updated_at.date().isoformat()}.csv"
+    with _get_catalog_lock(output_dir):
+        fpath = (output_dir / filename).resolve()
+        if archived_filename is None and (fpath.exists() or fpath in reserved_fpaths):
+            filename = f"{Path(filename).stem}_{spec['release'] or name}.csv"
+            fpath = (output_dir / filename).resolve()
+        if reserve:
+            reserved_fpaths.add(fpath)
+    return filename
+
+
+def archive_dataset(name, spec: dict, now: datetime = None, fetch_trigger="manual",
+                    force=False, dry_run=False, timeout=60., metadata=None,
+                    update_catalog=True, hooks=None, reserved_fpaths=None) -> dict:
+    """Fetch a dataset and add it to its archive, if its data was
+    updated since the last archived file, then run its post-archive
+    hooks on the new file. With `force`, data that is already archived
+    is fetched again, and overwrites its file and catalog entry.
+
+    `metadata` is the SODA metadata of the dataset, requested if not
+    given. With `update_catalog=False`, the file is archived but not
+    added to the catalog (nor copied as the latest file). `hooks`
+    defaults to the `post_archive_hooks` of the dataset. Files reserved
+    by other datasets of the same run are in `reserved_fpaths`.
+
+    Returns a dictionary with the dataset name, the status ("archived",
+    "up_to_date", "would_archive" in dry runs, or "failed"), the new
+    catalog entry, if any, and the hooks that failed.
+    """
+    now = now or datetime.now(tz=ZoneInfo("America/New_York"))
+    output_dir = Path(spec["output_dir"])
+    metadata_fpath = output_dir / _METADATA_FNAME
+    if reserved_fpaths is None:
+        reserved_fpaths = set()
+
+    try:
+        if metadata is None:
+            metadata = _request_json(spec["metadata_url_fmt"].format(uuid=spec["uuid"]), timeout=timeout)
+        updated_at = parse_updated_at(metadata["updatedAt"])
+
+        dataset_metadata = load_yaml(metadata_fpath) if metadata_fpath.exists() else dict(files=list())
+        last_updated_at = get_last_archived_updated_at(name, spec, dataset_metadata)
+        if not force and last_updated_at is not None and updated_at <= last_updated_at:
+            print(f"[{name}] Up to date (updatedAt = {updated_at.isoformat()}).")
+            return dict(dataset=name, status="up_to_date", entry=None, failed_hooks=[])
+
+        archived_filename = get_archived_filename(name, spec, dataset_metadata, updated_at)
+        if archived_filename is not None:
+            print(f"[{name}] Warning: {archived_filename} is already archived and will be overwritten.")
+        filename = _reserve_filename(
+            name, spec, updated_at, output_dir, reserved_fpaths, reserve=not dry_run,
+            archived_filename=archived_filename)
+        if dry_run:
+            print(f"[{name}] DRY RUN: would archive {filename} (updatedAt = {updated_at.isoformat()}).")
+            return dict(dataset=name, status="would_archive", entry=None, failed_hooks=[])
+
+        print(f"[{name}] Fetching into {output_dir / filename}...")
+        file_info = fetch_dataset_to_csv(spec, output_dir / filename, timeout=timeout)
+
+    except (requests.exceptions.RequestException, KeyError, ValueError) as err:
+        print(f"[{name}] Warning: archiving failed ({err.__class__.__name__}: {err}).")
+        return dict(dataset=name, status="failed", entry=None, failed_hooks=[])
+
+    entry = dict(
+        filename=filename,
+        fetched_on=now.isoformat(),
+        data_updated_at=metadata["updatedAt"],
+        fetch_trigger=fetch_trigger,
+        release=spec["release"],
+        dataset=name,
+        comments="",
+        sha256=file_info["sha256"],
+        num_rows=file_info["num_rows"],
+    )
+    if spec["release"] is None:
+        del entry["release"]
+
+    print(f"[{name}] Archived {filename} ({file_info['num_rows']} rows).")
+    if not update_catalog:
+        print(f"[{name}] The catalog was not updated, so the post-archive hooks are skipped.")
+        return dict(dataset=name, status="archived", entry=entry, failed_hooks=[])
+
+    # Reload the catalog, which may have been updated by another dataset.
+    # The hooks run under the lock too, as some of them (e.g. the cube)
+    # read the whole catalog.
+    with _get_catalog_lock(output_dir):
+        dataset_metadata = load_yaml(metadata_fpath) if metadata_fpath.exists() else dict(files=list())
+        files = dataset_metadata.setdefault("files", list())
+        replaced = [i for i, other in enumerate(files) if other["filename"] == filename]
+        if replaced:  # Refetched with `force`
+            files[replaced[0]] = entry
+            files[:] = [other for i, other in enumerate(files) if i not in replaced[1:]]
+        else:
+            files.append(entry)
+        dataset_metadata["last_updated"] = now.isoformat()
+        save_yaml(metadata_fpath, dataset_metadata)
+
+        # The `latest` copy is the most recently updated file of the archive
+        prefix_updated_at = [
+            parse_updated_at(other["data_updated_at"])
+            for other in dataset_metadata["files"]
+            if other["filename"].startswith(f"{spec['file_prefix']}_")
+            and other.get("data_updated_at") is not None
+        ]
+        if spec["save_latest"] and updated_at >= max(prefix_updated_at):
+            shutil.copy2(output_dir / filename, output_dir / f"{spec['file_prefix']}_latest.csv")
+
+        failed_hooks = run_post_archive_hooks(spec, entry, dataset_metadata, hooks=hooks)
+
+    return dict(dataset=name, status="archived", entry=entry, failed_hooks=failed_hooks)
+
+
+def archive_datasets(registry: dict, names=None, max_datasets=4, **kwargs) -> list:
+    """Archive several registered datasets concurrently, up to
+    `max_datasets` at a time. Keyword arguments are passed to
+    `archive_dataset`. Returns the result of each dataset.
+    """
+    names = list(registry) if names is None else list(names)
+    reserved_fpaths = set()  # Files written by this call
+    with ThreadPoolExecutor(max_workers=max_datasets) as executor:
+        return list(executor.map(
+            lambda name: archive_dataset(
+                name, registry[name], reserved_fpaths=reserved_fpaths, **kwargs),
+            names))
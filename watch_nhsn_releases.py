@@ -0,0 +1,118 @@
+"""Watch the NHSN datasets and archive each new release as soon as it is
+published. See `utils/release_scheduler.py` for the polling policy.
+
+Example:
+```bash
+python watch_nhsn_releases.py --metrics-file logs/release_captures.csv
+```
+"""
+
+import argparse
+from pathlib import Path
+
+from utils.nhsn_metadata import _NHSN_METADATA_REQUEST_FMT, get_catalog_updated_at
+from utils.release_scheduler import (
+    ReleaseScheduler, fetch_release_updated_at, run_pipeline_scripts,
+)
+from utils.yaml_tools import load_yaml
+
+
+def main():
+    args = parse_args()
+
+    # Start from the latest releases already in the archive
+    dataset_metadata = load_yaml(args.dataset_dir / "metadata.yaml")
+    last_updated_at = get_catalog_updated_at(dataset_metadata)
+    for release, updated_at in last_updated_at.items():
+        print(f"Last `{release}` release in the archive: {updated_at.isoformat()}")
+
+    if args.dry_run:
+        def run_pipeline(release):
+            print(f"DRY RUN: pipeline for `{release}` not executed.")
+            return True
+    else:
+        def run_pipeline(release):
+            return run_pipeline_scripts(release, make_report=args.report)
+
+    scheduler = ReleaseScheduler(
+        fetch_updated_at=lambda release: fetch_release_updated_at(
+            release, metadata_url_fmt=args.metadata_url_fmt),
+        run_pipeline=run_pipeline,
+        last_updated_at=last_updated_at,
+        min_interval=args.min_interval,
+        max_interval=args.max_interval,
+        metrics_path=args.metrics_file,
+    )
+
+    try:
+        scheduler.run(max_polls=args.max_polls)
+    except KeyboardInterrupt:
+        print("Scheduler stopped")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--dataset-dir",
+        type=Path,
+        help="Directory of the NHSN archive.",
+        default=Path("./datasets/nhsn_weekly_jurisdiction"),
+    )
+
+    parser.add_argument(
+        "--min-interval",
+        type=float,
+        help="Polling interval inside the release windows, in seconds.",
+        default=120.,
+    )
+
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        help="Maximum polling interval outside the release windows, in "
+             "seconds.",
+        default=3600.,
+    )
+
+    parser.add_argument(
+        "--metadata-url-fmt",
+        type=str,
+        help="Format of the metadata URL, with a `{uuid}` field. Change "
+             "it to poll a local stand-in server.",
+        default=_NHSN_METADATA_REQUEST_FMT,
+    )
+
+    parser.add_argument(
+        "--report",
+        action=argparse.BooleanOptionalAction,
+        help="Whether to rebuild the report after each capture.",
+        default=True,
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        type=Path,
+        help="CSV file to append the capture metrics (latency, pipeline "
+             "duration) to.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-polls",
+        type=int,
+        help="Stop after this number of polls. Defaults to run forever.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Poll and report changes, but do not run the pipeline.",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main()